@@ -1,4 +1,37 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
+from django.core.management import call_command
+from django.db.models.signals import post_migrate
+
+
+# Cache backends which keep their entries inside the worker process
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache')
+
 
 class BaseConfig(AppConfig):
     name = 'insekta.base'
+
+    def ready(self):
+        checks.register(check_shared_cache, checks.Tags.caches)
+        post_migrate.connect(_create_cache_table, sender=self)
+
+
+def check_shared_cache(app_configs, **kwargs):
+    # Cached badge counts, task ids, vm statuses etc. are invalidated by
+    # deleting them, which only works if all processes share the cache.
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        return [checks.Warning(
+            'The default cache is not shared between processes.',
+            hint='Use the database, Redis or Memcached cache backend if more than '
+                 'one worker process is running.',
+            id='insekta.W001',
+        )]
+    return []
+
+
+def _create_cache_table(sender, using, **kwargs):
+    # Like migrate, so that the database cache works without another command
+    call_command('createcachetable', database=using, verbosity=0)
@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+__all__ = ['LRUCache', 'SingleFlight']
+
+
+_missing = object()
+
+
+class SingleFlight:
+    """Per-key locks, so that only one thread at a time works on a key.
+
+    Threads waiting for the same key can use the result of the first
+    thread (e.g. from a cache) instead of repeating its work.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+
+class LRUCache:
+    """Thread-safe in-process cache which evicts the least recently used entry.
+
+    The cache is shared by all threads of a worker process. Values built
+    with :meth:`get_or_create` are only built once per key, even if several
+    threads ask for the same missing key at the same time.
+
+    By default max_size is the maximum number of entries. If weigh is given,
+    weigh(value) is used as the size of an entry instead, e.g. to bound
+    the cache by the length of cached strings.
+    """
+
+    def __init__(self, max_size, weigh=None):
+        self.max_size = max_size
+        self.weigh = weigh
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _weight = self._entries[key]
+            except KeyError:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        weight = 1 if self.weigh is None else self.weigh(value)
+        with self._lock:
+            self._remove(key)
+            if weight > self.max_size:
+                return
+            self._entries[key] = (value, weight)
+            self.size += weight
+            while self.size > self.max_size:
+                _key, (_value, old_weight) = self._entries.popitem(last=False)
+                self.size -= old_weight
+
+    def get_or_create(self, key, factory):
+        """Return the value for key, calling factory() to build it if missing.
+
+        :param key: Hashable cache key
+        :param factory: Callable without arguments returning the new value
+        :return: The cached or newly built value
+        """
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value
+        with self._single_flight.lock(key):
+            value = self.get(key, _missing)
+            if value is _missing:
+                value = factory()
+                self.set(key, value)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key, default=None):
+        try:
+            value, weight = self._entries.pop(key)
+        except KeyError:
+            return default
+        self.size -= weight
+        return value
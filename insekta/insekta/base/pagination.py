@@ -0,0 +1,120 @@
+import base64
+import binascii
+import json
+from collections.abc import Sequence
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+__all__ = ['KeysetPaginator', 'KeysetPage', 'InvalidCursor']
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPaginator:
+    """Paginates a queryset by the values of the last shown row.
+
+    Rows are ordered descending by the given fields, the last of which must
+    be unique. A page is loaded by filtering for rows before or after a
+    cursor, which encodes the field values of the first or last row of the
+    neighbouring page. Unlike Django's Paginator, this needs neither OFFSET
+    nor COUNT(*), so every page takes the same time if there is an index on
+    the fields. The total count is only computed if count is used, and then
+    cached under count_cache_key if it is given.
+    """
+
+    def __init__(self, queryset, per_page, fields=('time_created', 'pk'),
+                 count_cache_key=None, count_timeout=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = fields
+        self.count_cache_key = count_cache_key
+        self.count_timeout = count_timeout
+
+    @property
+    def count(self):
+        if self.count_cache_key is None:
+            return self.queryset.count()
+        return cache.get_or_set(self.count_cache_key, self.queryset.count, self.count_timeout)
+
+    def page(self, after=None, before=None):
+        """Return the page after or before a cursor.
+
+        :param after: Cursor of the previous page's last row or None
+        :param before: Cursor of the next page's first row or None
+        :return: KeysetPage, the first page if no cursor is given
+        :raises InvalidCursor: If the cursor could not be decoded
+        """
+        descending = ['-' + field for field in self.fields]
+        ascending = list(self.fields)
+        if after:
+            queryset = self.queryset.filter(self._get_filter(self.decode(after), 'lt'))
+            rows = list(queryset.order_by(*descending)[:self.per_page + 1])
+            has_previous, has_next = True, len(rows) > self.per_page
+            rows = rows[:self.per_page]
+        elif before:
+            queryset = self.queryset.filter(self._get_filter(self.decode(before), 'gt'))
+            rows = list(queryset.order_by(*ascending)[:self.per_page + 1])
+            has_previous, has_next = len(rows) > self.per_page, True
+            rows = rows[:self.per_page][::-1]
+        else:
+            rows = list(self.queryset.order_by(*descending)[:self.per_page + 1])
+            has_previous, has_next = False, len(rows) > self.per_page
+            rows = rows[:self.per_page]
+
+        next_cursor = self.encode(rows[-1]) if has_next and rows else None
+        previous_cursor = self.encode(rows[0]) if has_previous and rows else None
+        return KeysetPage(rows, self, next_cursor, previous_cursor)
+
+    def encode(self, obj):
+        values = [self._get_model_field(field).value_to_string(obj) for field in self.fields]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(self.fields):
+                raise ValueError('Wrong number of cursor values')
+            return [self._get_model_field(field).to_python(value)
+                    for field, value in zip(self.fields, values)]
+        except (ValueError, TypeError, binascii.Error, ValidationError) as e:
+            raise InvalidCursor(str(e))
+
+    def _get_filter(self, values, lookup):
+        # (a, b) < (x, y) is expanded to a < x OR (a = x AND b < y)
+        condition = Q()
+        for i, field in enumerate(self.fields):
+            equal = {self.fields[j]: values[j] for j in range(i)}
+            condition |= Q(**equal, **{'{}__{}'.format(field, lookup): values[i]})
+        return condition
+
+    def _get_model_field(self, field):
+        opts = self.queryset.model._meta
+        return opts.pk if field == 'pk' else opts.get_field(field)
+
+
+class KeysetPage(Sequence):
+    def __init__(self, object_list, paginator, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
@@ -1,4 +1,5 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from insekta.base.apps import check_shared_cache
 from insekta.base.utils import sanitize_markup
 
 class TestMarkup(TestCase):
@@ -11,3 +12,14 @@ class TestMarkup(TestCase):
         self.assertEqual(sanitized_markup, expected_markup)
         print(sanitized_markup)
         return False
+
+
+class SharedCacheCheckTestCase(TestCase):
+    def test_database_cache(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache(self):
+        warnings = check_shared_cache(None)
+        self.assertEqual([warning.id for warning in warnings], ['insekta.W001'])
@@ -1,28 +1,116 @@
+import asyncio
+import random
+import threading
+import time
 from datetime import timedelta, datetime
 
+import httpx
 import pytz
 import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.timezone import now
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
+from insekta.base.cache import SingleFlight
 from insekta.remoteapi.models import VMResourceDummy
 
 
 STATUS_OK = 200
+STATUS_NOT_FOUND = 404
+
+# Requests with these methods may be repeated even if the server could
+# have received them already
+IDEMPOTENT_METHODS = ('get', )
+
+RETRY_BASE_DELAY = 0.2
 
 
 class RemoteApiError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RemoteApiUnavailable(RemoteApiError):
     pass
 
 
+class CircuitBreaker:
+    """Stops sending requests to the remote API while it is failing.
+
+    The breaker is closed as long as requests succeed. After
+    failure_threshold consecutive failures it opens and requests fail
+    immediately with RemoteApiUnavailable. After reset_timeout seconds it
+    becomes half-open and lets a single request through: if it succeeds,
+    the breaker is closed again, otherwise it opens again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._num_failures = 0
+        self._opened_at = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._reset_timeout_expired():
+                return self.HALF_OPEN
+            return self._state
+
+    def before_request(self):
+        with self._lock:
+            if self._state == self.OPEN and self._reset_timeout_expired():
+                self._state = self.HALF_OPEN
+            if self._state == self.OPEN or (self._state == self.HALF_OPEN and
+                                            self._trial_running):
+                raise RemoteApiUnavailable('Remote API is unavailable, not sending request.')
+            if self._state == self.HALF_OPEN:
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._num_failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._num_failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._num_failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def _reset_timeout_expired(self):
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+
 class RemoteApiClient:
     api_version = '1.0'
 
-    def __init__(self, base_url, auth, session=None):
+    def __init__(self, base_url, auth, session=None, timeout=None, retries=0, pool_size=10,
+                 breaker=None):
         self.auth = auth
         self.api_url = base_url + self.api_version + '/'
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker
         if session is None:
             session = requests.Session()
+            # Wait for a free connection instead of opening more than pool_size
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
         self.session = session
 
     def start_vm_resource(self, resource_name, user):
@@ -40,10 +128,7 @@ class RemoteApiClient:
 
     def get_vm_resource_status(self, resource_name, user):
         ret = self._make_vm_request('vm/status', resource_name, user, method='get')
-        if ret['resource'] and ret['resource']['expire_time']:
-            resource = ret['resource']
-            resource['expire_time'] = datetime.fromtimestamp(resource['expire_time'], pytz.UTC)
-        return ret
+        return _parse_status(ret)
 
     def _make_vm_request(self, api_path, resource_name, user, method='post'):
         return self._make_request(api_path, {
@@ -52,17 +137,179 @@ class RemoteApiClient:
         }, method=method)
 
     def _make_request(self, api_path, data, method):
-        if method == 'post':
-            resp = self.session.post(self.api_url + api_path, data=data, auth=self.auth)
-        elif method == 'get':
-            resp = self.session.get(self.api_url + api_path, params=data, auth=self.auth)
-        else:
-            raise ValueError('Invalid value for method: {}'.format(method))
+        if self.breaker is None:
+            return self._send_request(api_path, data, method)
+        self.breaker.before_request()
+        try:
+            ret = self._send_request(api_path, data, method)
+        except RemoteApiError as e:
+            if e.status_code is None or e.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            # Any other error, e.g. an invalid JSON response, must not leave
+            # a half-open breaker waiting for its trial request forever
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return ret
+
+    def _send_request(self, api_path, data, method):
+        url = self.api_url + api_path
+        for attempt in range(self.retries + 1):
+            try:
+                if method == 'post':
+                    resp = self.session.post(url, data=data, auth=self.auth,
+                                             timeout=self.timeout)
+                elif method == 'get':
+                    resp = self.session.get(url, params=data, auth=self.auth,
+                                            timeout=self.timeout)
+                else:
+                    raise ValueError('Invalid value for method: {}'.format(method))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                may_retry = method in IDEMPOTENT_METHODS or _is_connect_error(e)
+                if not may_retry or attempt == self.retries:
+                    raise RemoteApiError('{} {}. {}'.format(method.upper(), api_path, e))
+                time.sleep(_get_retry_delay(attempt))
+            else:
+                break
+        if resp.status_code != STATUS_OK:
+            raise RemoteApiError('{} {}. HttpCode: {}: {}'.format(
+                method.upper(), api_path, resp.status_code, resp.text), resp.status_code)
+        return resp.json()
+
+
+class AsyncRemoteApiClient:
+    """Asynchronous client for the remote API.
+
+    Connections are kept in a pool of at most pool_size connections.
+    Failed requests are retried with exponential backoff and jitter, but
+    non-idempotent requests are only retried if the connection could not
+    be established.
+    """
+    api_version = '1.0'
+
+    def __init__(self, base_url, auth, transport=None, timeout=None, retries=0, pool_size=10,
+                 breaker=None):
+        self.auth = auth
+        self.api_url = base_url + self.api_version + '/'
+        self.transport = transport
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.breaker = breaker
+        self._client = None
+        self._client_loop = None
+
+    async def start_vm_resource(self, resource_name, user):
+        ret = await self._make_vm_request('vm/start', resource_name, user)
+        ret['expire_time'] = datetime.fromtimestamp(ret['expire_time'], pytz.UTC)
+        return ret
+
+    async def stop_vm_resource(self, resource_name, user):
+        return await self._make_vm_request('vm/stop', resource_name, user)
+
+    async def ping_vm_resource(self, resource_name, user):
+        ret = await self._make_vm_request('vm/ping', resource_name, user)
+        ret['expire_time'] = datetime.fromtimestamp(ret['expire_time'], pytz.UTC)
+        return ret
+
+    async def get_vm_resource_status(self, resource_name, user):
+        ret = await self._make_vm_request('vm/status', resource_name, user, method='get')
+        return _parse_status(ret)
+
+    async def get_vm_resource_statuses(self, resources):
+        """Returns the status of many vm resources with a single request.
+
+        Falls back to concurrent single requests if the remote API does
+        not support bulk requests.
+
+        :param resources: List of (resource_name, user) tuples
+        :return: List of status dicts in the same order as resources
+        """
+        if not resources:
+            return []
+        try:
+            ret = await self._make_request('vm/status_bulk', {
+                'resources': [{'resource': resource_name, 'username': user.username}
+                              for resource_name, user in resources]
+            }, method='post_json')
+        except RemoteApiError as e:
+            if e.status_code != STATUS_NOT_FOUND:
+                raise
+            return await asyncio.gather(*(self.get_vm_resource_status(resource_name, user)
+                                          for resource_name, user in resources))
+        return [_parse_status(status) for status in ret['statuses']]
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _make_vm_request(self, api_path, resource_name, user, method='post'):
+        return await self._make_request(api_path, {
+            'resource': resource_name,
+            'username': user.username
+        }, method=method)
+
+    async def _make_request(self, api_path, data, method):
+        if self.breaker is None:
+            return await self._send_request(api_path, data, method)
+        self.breaker.before_request()
+        try:
+            ret = await self._send_request(api_path, data, method)
+        except RemoteApiError as e:
+            if e.status_code is None or e.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return ret
+
+    async def _send_request(self, api_path, data, method):
+        client = self._get_client()
+        url = self.api_url + api_path
+        for attempt in range(self.retries + 1):
+            try:
+                if method == 'post':
+                    resp = await client.post(url, data=data)
+                elif method == 'post_json':
+                    resp = await client.post(url, json=data)
+                elif method == 'get':
+                    resp = await client.get(url, params=data)
+                else:
+                    raise ValueError('Invalid value for method: {}'.format(method))
+            except httpx.TransportError as e:
+                # Same rule as _is_connect_error for the synchronous client
+                may_retry = (method in IDEMPOTENT_METHODS or
+                             isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)))
+                if not may_retry or attempt == self.retries:
+                    raise RemoteApiError('{} {}. {!r}'.format(method.upper(), api_path, e))
+                await asyncio.sleep(_get_retry_delay(attempt))
+            else:
+                break
         if resp.status_code != STATUS_OK:
             raise RemoteApiError('{} {}. HttpCode: {}: {}'.format(
-                method.upper(), api_path, resp.status_code, resp.text))
+                method.upper(), api_path, resp.status_code, resp.text), resp.status_code)
         return resp.json()
 
+    def _get_client(self):
+        # httpx clients are bound to the event loop they were used on first
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            limits = httpx.Limits(max_connections=self.pool_size,
+                                  max_keepalive_connections=self.pool_size)
+            self._client = httpx.AsyncClient(auth=self.auth, timeout=self.timeout,
+                                             limits=limits, transport=self.transport)
+            self._client_loop = loop
+        return self._client
+
 
 class RemoteApiClientDummy:
     def start_vm_resource(self, resource_name, user):
@@ -123,9 +370,139 @@ class RemoteApiClientDummy:
             raise RemoteApiError('No such vm resource: {}'.format(resource_name))
 
 
+class AsyncRemoteApiClientDummy:
+    def __init__(self, client):
+        self.client = client
+
+    async def start_vm_resource(self, resource_name, user):
+        return await sync_to_async(self.client.start_vm_resource)(resource_name, user)
+
+    async def stop_vm_resource(self, resource_name, user):
+        return await sync_to_async(self.client.stop_vm_resource)(resource_name, user)
+
+    async def ping_vm_resource(self, resource_name, user):
+        return await sync_to_async(self.client.ping_vm_resource)(resource_name, user)
+
+    async def get_vm_resource_status(self, resource_name, user):
+        return await sync_to_async(self.client.get_vm_resource_status)(resource_name, user)
+
+    async def get_vm_resource_statuses(self, resources):
+        get_status = self.client.get_vm_resource_status
+        return await sync_to_async(lambda: [get_status(resource_name, user)
+                                            for resource_name, user in resources])()
+
+    async def aclose(self):
+        pass
+
+
+class CachedRemoteApi:
+    """Caches the vm resource status returned by a remote API client.
+
+    Statuses are cached for timeout seconds per resource and user. If
+    several threads ask for the same missing status, only one request is
+    made. Starting, stopping and pinging vm resources update the cached
+    status with their result.
+    """
+
+    def __init__(self, client, timeout):
+        self.client = client
+        self.timeout = timeout
+        self._single_flight = SingleFlight()
+
+    def start_vm_resource(self, resource_name, user):
+        ret = self.client.start_vm_resource(resource_name, user)
+        self._update_status(resource_name, user, lambda status: {
+            'status': 'running',
+            'resource': {
+                'id': ret['id'],
+                'expire_time': ret['expire_time'],
+                'virtual_machines': ret['virtual_machines']
+            },
+            'vpn_ip': status['vpn_ip']
+        })
+        return ret
+
+    def stop_vm_resource(self, resource_name, user):
+        ret = self.client.stop_vm_resource(resource_name, user)
+        self._update_status(resource_name, user, lambda status: {
+            'status': 'notrunning',
+            'resource': None,
+            'vpn_ip': status['vpn_ip']
+        })
+        return ret
+
+    def ping_vm_resource(self, resource_name, user):
+        ret = self.client.ping_vm_resource(resource_name, user)
+
+        def update(status):
+            if not status['resource']:
+                return status
+            resource = dict(status['resource'], expire_time=ret['expire_time'])
+            return dict(status, resource=resource)
+
+        self._update_status(resource_name, user, update)
+        return ret
+
+    def get_vm_resource_status(self, resource_name, user):
+        key = self._get_status_key(resource_name, user)
+        status = cache.get(key)
+        if status is not None:
+            return status
+        with self._single_flight.lock(key):
+            status = cache.get(key)
+            if status is None:
+                status = self.client.get_vm_resource_status(resource_name, user)
+                cache.set(key, status, self.timeout)
+        return status
+
+    def _update_status(self, resource_name, user, update_fn):
+        key = self._get_status_key(resource_name, user)
+        with self._single_flight.lock(key):
+            status = cache.get(key)
+            if status is not None:
+                cache.set(key, update_fn(status), self.timeout)
+
+    @staticmethod
+    def _get_status_key(resource_name, user):
+        return 'remoteapi:status:{}:{}'.format(resource_name, user.pk)
+
+
+def _parse_status(ret):
+    if ret['resource'] and ret['resource']['expire_time']:
+        resource = ret['resource']
+        resource['expire_time'] = datetime.fromtimestamp(resource['expire_time'], pytz.UTC)
+    return ret
+
+
+def _is_connect_error(e):
+    # The request was not sent if the connection could not be established
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _get_retry_delay(attempt):
+    return RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
 if settings.USE_REMOTE_API_DUMMY:
-    remote_api = RemoteApiClientDummy()
+    _client = RemoteApiClientDummy()
+    async_remote_api = AsyncRemoteApiClientDummy(_client)
 else:
-    remote_api = RemoteApiClient(settings.REMOTE_API_URL,
-                                 settings.REMOTE_API_AUTH,
-                                 requests.Session())
+    _breaker = CircuitBreaker(settings.REMOTE_API_BREAKER_THRESHOLD,
+                              settings.REMOTE_API_BREAKER_RESET_TIMEOUT)
+    _client = RemoteApiClient(settings.REMOTE_API_URL,
+                              settings.REMOTE_API_AUTH,
+                              timeout=settings.REMOTE_API_TIMEOUT,
+                              retries=settings.REMOTE_API_RETRIES,
+                              pool_size=settings.REMOTE_API_POOL_SIZE,
+                              breaker=_breaker)
+    async_remote_api = AsyncRemoteApiClient(settings.REMOTE_API_URL,
+                                            settings.REMOTE_API_AUTH,
+                                            timeout=settings.REMOTE_API_TIMEOUT,
+                                            retries=settings.REMOTE_API_RETRIES,
+                                            pool_size=settings.REMOTE_API_POOL_SIZE,
+                                            breaker=_breaker)
+
+remote_api = CachedRemoteApi(_client, settings.REMOTE_API_STATUS_CACHE_TIMEOUT)
@@ -1,3 +1,267 @@
+import json
+import time
+from unittest import mock
+
+import httpx
+import requests
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from insekta.remoteapi.client import (AsyncRemoteApiClient, CachedRemoteApi, CircuitBreaker,
+                                      RemoteApiClient, RemoteApiClientDummy, RemoteApiError,
+                                      RemoteApiUnavailable)
+from insekta.remoteapi.models import VMResourceDummy
+
+
+class CountingClient(RemoteApiClientDummy):
+    def __init__(self):
+        self.num_status_requests = 0
+
+    def get_vm_resource_status(self, resource_name, user):
+        self.num_status_requests += 1
+        return super().get_vm_resource_status(resource_name, user)
+
+
+class FakeSession:
+    """Raises the given errors for the first requests, then responds."""
+
+    def __init__(self, errors, status_code=200, body=None):
+        self.errors = list(errors)
+        self.status_code = status_code
+        self.body = body if body is not None else {'result': 'ok'}
+        self.num_requests = 0
+
+    def post(self, url, **kwargs):
+        return self._respond()
+
+    def get(self, url, **kwargs):
+        return self._respond()
+
+    def _respond(self):
+        self.num_requests += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        response = mock.Mock(status_code=self.status_code, text='error')
+        response.json.return_value = self.body
+        return response
+
+
+class CachedRemoteApiTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        VMResourceDummy.objects.create(resource_name='res', vm_names='box')
+        self.client = CountingClient()
+        self.remote_api = CachedRemoteApi(self.client, timeout=60)
+
+    def test_status_is_cached(self):
+        status = self.remote_api.get_vm_resource_status('res', self.user)
+        self.assertEqual(status['status'], 'notrunning')
+        self.remote_api.get_vm_resource_status('res', self.user)
+        self.assertEqual(self.client.num_status_requests, 1)
+
+    def test_start_and_stop_update_status(self):
+        self.remote_api.get_vm_resource_status('res', self.user)
+        self.remote_api.start_vm_resource('res', self.user)
+        status = self.remote_api.get_vm_resource_status('res', self.user)
+        self.assertEqual(status['status'], 'running')
+        self.assertIn('box', status['resource']['virtual_machines'])
+        self.remote_api.stop_vm_resource('res', self.user)
+        status = self.remote_api.get_vm_resource_status('res', self.user)
+        self.assertEqual(status['status'], 'notrunning')
+        self.assertEqual(self.client.num_status_requests, 1)
+
+
+class CircuitBreakerTestCase(TestCase):
+    def test_states(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.before_request()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_request()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(RemoteApiUnavailable):
+            breaker.before_request()
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.before_request()
+        # Only a single trial request is let through
+        with self.assertRaises(RemoteApiUnavailable):
+            breaker.before_request()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.06)
+        breaker.before_request()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+@mock.patch('insekta.remoteapi.client.time.sleep')
+class RetryTestCase(TestCase):
+    def get_client(self, session, retries=2):
+        return RemoteApiClient('http://remoteapi/', ('api', 'x'), session=session,
+                               timeout=1, retries=retries)
+
+    def test_get_is_retried(self, sleep):
+        session = FakeSession([requests.ReadTimeout(), requests.ConnectionError()])
+        self.assertEqual(self.get_client(session)._send_request('vm/status', {}, 'get'),
+                         {'result': 'ok'})
+        self.assertEqual(session.num_requests, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_post_is_retried_if_not_sent(self, sleep):
+        session = FakeSession([requests.ConnectTimeout()])
+        self.get_client(session)._send_request('vm/start', {}, 'post')
+        self.assertEqual(session.num_requests, 2)
+
+        # Connection refused, raised like requests does for a closed port
+        session = requests.Session()
+        client = RemoteApiClient('http://127.0.0.1:1/', ('api', 'x'), session=session,
+                                 timeout=1, retries=2)
+        with self.assertRaises(RemoteApiError):
+            client._send_request('vm/start', {}, 'post')
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_post_is_not_retried_if_sent(self, sleep):
+        session = FakeSession([requests.ReadTimeout()])
+        with self.assertRaises(RemoteApiError):
+            self.get_client(session)._send_request('vm/start', {}, 'post')
+        self.assertEqual(session.num_requests, 1)
+
+    def test_retries_exhausted(self, sleep):
+        session = FakeSession([requests.ConnectTimeout()] * 3)
+        with self.assertRaises(RemoteApiError) as cm:
+            self.get_client(session)._send_request('vm/status', {}, 'get')
+        self.assertIsNone(cm.exception.status_code)
+        self.assertEqual(session.num_requests, 3)
+
+    def test_error_status(self, sleep):
+        session = FakeSession([], status_code=503)
+        with self.assertRaises(RemoteApiError) as cm:
+            self.get_client(session)._send_request('vm/status', {}, 'get')
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertEqual(session.num_requests, 1)
+
+    def test_pool_is_bounded(self, sleep):
+        client = RemoteApiClient('http://remoteapi/', ('api', 'x'), pool_size=3)
+        adapter = client.session.get_adapter('http://remoteapi/')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertTrue(adapter._pool_block)
+
+
+@mock.patch('insekta.remoteapi.client.asyncio.sleep', new_callable=mock.AsyncMock)
+class AsyncClientTestCase(TestCase):
+    def setUp(self):
+        self.alice = mock.Mock(username='alice')
+        self.bob = mock.Mock(username='bob')
+        self.requests = []
+
+    def get_client(self, handler, retries=2):
+        def record(request):
+            self.requests.append(request)
+            return handler(request)
+        return AsyncRemoteApiClient('http://remoteapi/', ('api', 'x'),
+                                    transport=httpx.MockTransport(record),
+                                    timeout=1, retries=retries)
+
+    @staticmethod
+    def get_status(username):
+        return {'status': 'notrunning', 'resource': None, 'vpn_ip': username}
+
+    async def test_bulk_status(self, sleep):
+        def handler(request):
+            resources = json.loads(request.content)['resources']
+            return httpx.Response(200, json={
+                'statuses': [self.get_status(r['username']) for r in resources]
+            })
+
+        client = self.get_client(handler)
+        statuses = await client.get_vm_resource_statuses([('res', self.alice),
+                                                          ('res', self.bob)])
+        await client.aclose()
+        self.assertEqual([status['vpn_ip'] for status in statuses], ['alice', 'bob'])
+        self.assertEqual([request.url.path for request in self.requests],
+                         ['/1.0/vm/status_bulk'])
+
+    async def test_bulk_status_fallback(self, sleep):
+        def handler(request):
+            if request.url.path.endswith('status_bulk'):
+                return httpx.Response(404, text='Not found')
+            return httpx.Response(200, json=self.get_status(request.url.params['username']))
+
+        client = self.get_client(handler)
+        statuses = await client.get_vm_resource_statuses([('res', self.alice),
+                                                          ('res', self.bob)])
+        await client.aclose()
+        self.assertEqual([status['vpn_ip'] for status in statuses], ['alice', 'bob'])
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_post_is_retried_if_not_sent(self, sleep):
+        errors = [httpx.ConnectError('Connection refused')]
+
+        def handler(request):
+            if errors:
+                raise errors.pop(0)
+            return httpx.Response(200, json={'result': 'ok'})
+
+        client = self.get_client(handler)
+        self.assertEqual(await client.stop_vm_resource('res', self.alice), {'result': 'ok'})
+        await client.aclose()
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(sleep.await_count, 1)
+
+    async def test_post_is_not_retried_if_sent(self, sleep):
+        def handler(request):
+            raise httpx.ReadTimeout('Timed out')
+
+        client = self.get_client(handler)
+        with self.assertRaises(RemoteApiError):
+            await client.stop_vm_resource('res', self.alice)
+        await client.aclose()
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_get_is_retried(self, sleep):
+        def handler(request):
+            raise httpx.ReadTimeout('Timed out')
+
+        client = self.get_client(handler)
+        with self.assertRaises(RemoteApiError) as cm:
+            await client.get_vm_resource_status('res', self.alice)
+        await client.aclose()
+        self.assertIsNone(cm.exception.status_code)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(sleep.await_count, 2)
+
+    async def test_breaker(self, sleep):
+        client = self.get_client(lambda request: httpx.Response(503, text='Unavailable'))
+        client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        with self.assertRaises(RemoteApiError):
+            await client.get_vm_resource_status('res', self.alice)
+        with self.assertRaises(RemoteApiUnavailable):
+            await client.get_vm_resource_status('res', self.alice)
+        await client.aclose()
+        self.assertEqual(len(self.requests), 1)
+
+
+class BreakerClientTestCase(TestCase):
+    def test_trial_with_invalid_response(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.before_request()
+        breaker.record_failure()
+        session = FakeSession([])
+        client = RemoteApiClient('http://remoteapi/', ('api', 'x'), session=session,
+                                 breaker=breaker)
+        # A proxy responds to the trial request with an HTML page
+        html_response = mock.Mock(status_code=200, text='<html>')
+        html_response.json.side_effect = requests.JSONDecodeError('Expecting value', '<html>', 0)
+        with mock.patch.object(session, 'get', return_value=html_response):
+            with self.assertRaises(requests.JSONDecodeError):
+                client._make_request('vm/status', {}, 'get')
+        # Another trial request is let through after the reset timeout
+        self.assertEqual(client._make_request('vm/status', {}, 'get'), {'result': 'ok'})
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
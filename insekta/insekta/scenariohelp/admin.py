@@ -24,7 +24,7 @@ class PostAdmin(admin.ModelAdmin):
 
 
 class SeenQuestionAdmin(admin.ModelAdmin):
-    list_display = ('question', 'user')
+    list_display = ('question', 'user', 'last_seen_post_id')
     list_filter = ('user', )
 
 
@@ -1,5 +1,17 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
 
 class ScenarioHelpConfig(AppConfig):
     name = 'insekta.scenariohelp'
 
+    def ready(self):
+        post_migrate.connect(_create_fts_table, sender=self)
+
+
+def _create_fts_table(sender, using, **kwargs):
+    # The migrations only run on PostgreSQL, which keeps the search index in
+    # a column of the post table. SQLite needs a separate FTS5 table.
+    from insekta.scenariohelp.search import create_fts_table
+    create_fts_table(connections[using])
@@ -1,5 +1,17 @@
 from django import forms
+from django.utils.translation import gettext_lazy as _
+
+from insekta.scenarios.models import Course, Scenario
+
 
 class NewQuestionForm(forms.Form):
     title = forms.CharField(max_length=120)
-    text = forms.CharField(widget=forms.Textarea())
\ No newline at end of file
+    text = forms.CharField(widget=forms.Textarea())
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField(max_length=200, label=_('Search'))
+    course = forms.ModelChoiceField(Course.objects.filter(enabled=True), required=False,
+                                    label=_('Course'))
+    scenario = forms.ModelChoiceField(Scenario.objects.filter(enabled=True), required=False,
+                                      to_field_name='key', widget=forms.HiddenInput)
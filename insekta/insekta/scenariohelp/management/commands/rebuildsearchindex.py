@@ -0,0 +1,13 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from insekta.scenariohelp.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search index of the help questions and posts'
+
+    def handle(self, *args, **options):
+        num_indexed = rebuild_index()
+        sys.stdout.write('Indexed posts: {}\n'.format(num_indexed))
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:41
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_watermarks(apps, schema_editor):
+    Question = apps.get_model('scenariohelp', 'Question')
+    Post = apps.get_model('scenariohelp', 'Post')
+    SeenQuestion = apps.get_model('scenariohelp', 'SeenQuestion')
+    last_post_ids = (Post.objects.filter(question=OuterRef('pk')).order_by()
+                     .values('question').annotate(last_post_id=Max('pk')).values('last_post_id'))
+    Question.objects.update(last_post_id=Coalesce(Subquery(last_post_ids), 0))
+    # Existing rows mean that the user has seen the question
+    question_last_post_ids = Question.objects.filter(pk=OuterRef('question')).values('last_post_id')
+    SeenQuestion.objects.update(last_seen_post_id=Subquery(question_last_post_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenariohelp', '0005_alter_post_id_alter_question_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='last_post_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='seenquestion',
+            name='last_seen_post_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenariohelp', '0006_read_watermarks'),
+        ('scenarios', '0029_scenarioprogress_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['scenario', 'is_solved', '-time_created', '-id'], name='question_scenario_solved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['author', '-time_created', '-id'], name='question_author_created_idx'),
+        ),
+    ]
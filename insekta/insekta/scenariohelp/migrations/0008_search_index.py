@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+# On SQLite, the FTS5 table is created after migrate by the app config
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE scenariohelp_post ADD COLUMN search_vector tsvector')
+        schema_editor.execute('''
+        UPDATE scenariohelp_post AS p
+        SET search_vector = setweight(to_tsvector('simple', q.title), 'A') ||
+                            setweight(to_tsvector('simple', regexp_replace(p.text, '<[^>]*>',
+                                                                           ' ', 'g')), 'B')
+        FROM scenariohelp_question AS q
+        WHERE q.id = p.question_id
+        ''')
+        schema_editor.execute('CREATE INDEX scenariohelp_post_search_idx '
+                              'ON scenariohelp_post USING gin (search_vector)')
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE scenariohelp_post DROP COLUMN search_vector')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenariohelp', '0007_question_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,13 +1,22 @@
+from collections import namedtuple
+
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models, connection
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
 from django.utils.timezone import now
 
+from insekta.scenariohelp.search import index_post
 from insekta.scenarios.models import Course, Scenario
 
 READ_STATES = (
     ('read', 'Read questions')
 )
 
+BadgeCounts = namedtuple('BadgeCounts', ['num_unseen', 'num_answered'])
+
 
 class Question(models.Model):
     title = models.CharField(max_length=120)
@@ -17,6 +26,19 @@ class Question(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE)
     is_solved = models.BooleanField(default=False, db_index=True)
     seen_by_author = models.BooleanField(default=True)
+    # Id of the newest post, compared with SeenQuestion.last_seen_post_id
+    last_post_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the questions of a scenario and of a user
+            models.Index(fields=['scenario', 'is_solved', '-time_created', '-id'],
+                         name='question_scenario_solved_idx'),
+            models.Index(fields=['author', '-time_created', '-id'],
+                         name='question_author_created_idx'),
+        ]
+
+    solved_count_cache_key = 'scenariohelp:num_solved:{}'
 
     def __str__(self):
         return self.title
@@ -28,30 +50,38 @@ class Question(models.Model):
                                    author=author,
                                    text=text,
                                    time_created=time_created)
-        # If the creator of the question has written a post, we want to mark
-        # the question as unread for all users who participated in the
-        # discussion.
-        if author == self.author:
-            other_posts = (Post.objects.filter(question=self, author=author)
-                           .select_related('author'))
-            other_authors = [other_post.author for other_post in other_posts]
-            SeenQuestion.objects.filter(question=self, user__in=other_authors).delete()
-        else:
+        index_post(post, self)
+        # A new post makes the question unread for everyone who has seen it
+        # before, except for the author of the post.
+        changes = {'last_post_id': Greatest(F('last_post_id'), Value(post.pk))}
+        if author.pk != self.author_id:
+            changes['seen_by_author'] = False
             self.seen_by_author = False
-            self.save()
+            SeenQuestion.mark_seen(self, author, post.pk)
+        Question.objects.filter(pk=self.pk).update(**changes)
+        self.last_post_id = max(self.last_post_id, post.pk)
+        self._invalidate_badge_counts()
         return post
 
     def mark_seen(self, user):
-        if user == self.author:
-            self.seen_by_author = True
-            self.save()
-        else:
-            SeenQuestion.objects.get_or_create(question=self, user=user)
+        if user.pk == self.author_id:
+            if not self.seen_by_author:
+                self.seen_by_author = True
+                self.save(update_fields=['seen_by_author'])
+                invalidate_badge_counts([self.author_id])
+        elif SeenQuestion.mark_seen(self, user, self.last_post_id):
+            invalidate_badge_counts([user.pk])
 
     def mark_solved(self):
         self.is_solved = True
-        SeenQuestion.objects.filter(question=self).delete()
-        self.save()
+        self.save(update_fields=['is_solved'])
+        cache.delete(self.solved_count_cache_key.format(self.scenario_id))
+        self._invalidate_badge_counts()
+
+    def _invalidate_badge_counts(self):
+        supporter_ids = list(SupportedScenario.objects.filter(scenario_id=self.scenario_id)
+                             .values_list('user_id', flat=True))
+        invalidate_badge_counts(supporter_ids + [self.author_id])
 
 
 class Post(models.Model):
@@ -65,8 +95,10 @@ class Post(models.Model):
 
 
 class SeenQuestion(models.Model):
+    """Watermark up to which post a user has seen a question."""
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    last_seen_post_id = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = ('question', 'user')
@@ -74,6 +106,23 @@ class SeenQuestion(models.Model):
     def __str__(self):
         return '{} helped at {}'.format(self.user, self.question)
 
+    @classmethod
+    def mark_seen(cls, question, user, post_id):
+        """Move the watermark of a user forward to post_id.
+
+        :return: True if the watermark was moved
+        """
+        table = cls._meta.db_table
+        sql_query = '''
+        INSERT INTO {table} (question_id, user_id, last_seen_post_id) VALUES (%s, %s, %s)
+        ON CONFLICT (question_id, user_id) DO UPDATE
+        SET last_seen_post_id = EXCLUDED.last_seen_post_id
+        WHERE {table}.last_seen_post_id < EXCLUDED.last_seen_post_id
+        '''.format(table=table)
+        with connection.cursor() as c:
+            c.execute(sql_query, (question.pk, user.pk, post_id))
+            return c.rowcount > 0
+
 
 class SupportedScenario(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='supported_scenarios',
@@ -88,16 +137,54 @@ class SupportedScenario(models.Model):
 
 
 def get_num_unseen(user):
-    sql_query = '''
-    SELECT COUNT(q.id)
-    FROM scenariohelp_question AS q
-    LEFT JOIN scenariohelp_seenquestion AS sq ON q.id = sq.question_id
-    WHERE NOT q.is_solved AND
-          q.author_id <> %s AND
-          sq.id IS NULL AND
-          q.scenario_id IN
-            (SELECT scenario_id FROM scenariohelp_supportedscenario WHERE user_id = %s)
-    '''
-    with connection.cursor() as c:
-        c.execute(sql_query, (user.pk, user.pk))
-        return c.fetchone()[0]
+    return get_badge_counts(user).num_unseen
+
+
+def get_badge_counts(user):
+    """Returns the numbers shown in the navigation badges of a user.
+
+    Both numbers are computed with one query and cached until questions,
+    posts or supported scenarios of the user change.
+
+    :return: BadgeCounts with the number of unseen questions of supported
+             scenarios and the number of own questions with unseen answers
+    """
+    key = _get_badge_cache_key(user.pk)
+    badge_counts = cache.get(key)
+    if badge_counts is None:
+        sql_query = '''
+        SELECT
+          (SELECT COUNT(q.id)
+           FROM scenariohelp_question AS q
+           INNER JOIN scenariohelp_supportedscenario AS ss
+             ON ss.scenario_id = q.scenario_id AND ss.user_id = %s
+           LEFT JOIN scenariohelp_seenquestion AS sq
+             ON sq.question_id = q.id AND sq.user_id = %s
+           WHERE NOT q.is_solved AND
+                 q.author_id <> %s AND
+                 (sq.id IS NULL OR sq.last_seen_post_id < q.last_post_id)),
+          (SELECT COUNT(*)
+           FROM scenariohelp_question
+           WHERE author_id = %s AND NOT seen_by_author)
+        '''
+        with connection.cursor() as c:
+            c.execute(sql_query, (user.pk, user.pk, user.pk, user.pk))
+            badge_counts = BadgeCounts(*c.fetchone())
+        cache.set(key, badge_counts, settings.SCENARIOHELP_BADGE_CACHE_TIMEOUT)
+    return badge_counts
+
+
+def invalidate_badge_counts(user_ids):
+    cache.delete_many([_get_badge_cache_key(user_id) for user_id in user_ids])
+
+
+def _get_badge_cache_key(user_id):
+    return 'scenariohelp:badges:{}'.format(user_id)
+
+
+def _invalidate_supporter_badge_counts(sender, instance, **kwargs):
+    invalidate_badge_counts([instance.user_id])
+
+
+post_save.connect(_invalidate_supporter_badge_counts, sender=SupportedScenario)
+post_delete.connect(_invalidate_supporter_badge_counts, sender=SupportedScenario)
@@ -0,0 +1,167 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+
+
+__all__ = ['index_post', 'search_questions', 'rebuild_index', 'create_fts_table']
+
+
+# Questions are asked in several languages, so words are not stemmed
+SEARCH_CONFIG = 'simple'
+
+SEARCH_TERM_RE = re.compile(r'\w+')
+
+# Tags are replaced by spaces, so that words in adjacent elements stay
+# separate. The SQL of rebuild_index and the migration uses the same pattern.
+TAG_RE = re.compile(r'<[^>]*>')
+
+# Other databases have no search index, searches return no results there
+SUPPORTED_VENDORS = ('postgresql', 'sqlite')
+
+
+def index_post(post, question):
+    """Add a post to the search index.
+
+    On PostgreSQL, the tsvector column of the post is updated. On SQLite,
+    a row is inserted into the FTS5 table.
+
+    :param post: Post object
+    :param question: Question of the post, its title is indexed too
+    """
+    text = TAG_RE.sub(' ', post.text)
+    with connection.cursor() as c:
+        if connection.vendor == 'postgresql':
+            c.execute('''
+            UPDATE scenariohelp_post
+            SET search_vector = setweight(to_tsvector(%s, %s), 'A') ||
+                                setweight(to_tsvector(%s, %s), 'B')
+            WHERE id = %s
+            ''', (SEARCH_CONFIG, question.title, SEARCH_CONFIG, text, post.pk))
+        elif connection.vendor == 'sqlite':
+            c.execute('INSERT OR REPLACE INTO scenariohelp_post_fts (rowid, title, text) '
+                      'VALUES (%s, %s, %s)', (post.pk, question.title, text))
+
+
+def search_questions(query, scenario=None, course=None, limit=None):
+    """Search the titles and posts of questions.
+
+    Questions match if one of their posts contains all words of the query.
+    They are ordered by the rank of their best matching post, matches in
+    the title weigh more than matches in the text.
+
+    :param query: str with the words to search for
+    :param scenario: Only return questions of this scenario if given
+    :param course: Only return questions of this course if given
+    :param limit: Maximum number of questions, SCENARIOHELP_SEARCH_LIMIT
+                  if None
+    :return: List of Question objects with an attribute search_rank
+    """
+    from insekta.scenariohelp.models import Question
+
+    if connection.vendor not in SUPPORTED_VENDORS:
+        return []
+    if limit is None:
+        limit = settings.SCENARIOHELP_SEARCH_LIMIT
+    terms = SEARCH_TERM_RE.findall(query)
+    if not terms:
+        return []
+
+    filters = []
+    params = []
+    if scenario is not None:
+        filters.append('AND q.scenario_id = %s')
+        params.append(scenario.pk)
+    if course is not None:
+        filters.append('AND q.course_id = %s')
+        params.append(course.pk)
+
+    if connection.vendor == 'postgresql':
+        sql_query = '''
+        SELECT p.question_id, MAX(ts_rank(p.search_vector, query)) AS search_rank
+        FROM scenariohelp_post AS p
+        INNER JOIN scenariohelp_question AS q ON q.id = p.question_id
+        CROSS JOIN plainto_tsquery(%s, %s) AS query
+        WHERE p.search_vector @@ query {}
+        GROUP BY p.question_id
+        ORDER BY search_rank DESC
+        LIMIT %s
+        '''
+        params = [SEARCH_CONFIG, ' '.join(terms)] + params + [limit]
+    else:
+        # bm25 is smaller for better matches, the rank is negated to be
+        # ordered like on PostgreSQL.
+        sql_query = '''
+        SELECT p.question_id, -MIN(f.rank) AS search_rank
+        FROM scenariohelp_post_fts AS f
+        INNER JOIN scenariohelp_post AS p ON p.id = f.rowid
+        INNER JOIN scenariohelp_question AS q ON q.id = p.question_id
+        WHERE scenariohelp_post_fts MATCH %s {}
+        GROUP BY p.question_id
+        ORDER BY search_rank DESC
+        LIMIT %s
+        '''
+        match = ' '.join('"{}"'.format(term) for term in terms)
+        params = [match] + params + [limit]
+
+    with connection.cursor() as c:
+        c.execute(sql_query.format(' '.join(filters)), params)
+        ranks = c.fetchall()
+
+    questions = (Question.objects.select_related('author', 'course', 'scenario')
+                 .in_bulk([question_id for question_id, _rank in ranks]))
+    results = []
+    for question_id, search_rank in ranks:
+        question = questions[question_id]
+        question.search_rank = search_rank
+        results.append(question)
+    return results
+
+
+def rebuild_index():
+    """Index all posts again.
+
+    :return: Number of indexed posts
+    """
+    from insekta.scenariohelp.models import Post
+
+    if connection.vendor not in SUPPORTED_VENDORS:
+        return 0
+    with connection.cursor() as c:
+        if connection.vendor == 'postgresql':
+            c.execute('''
+            UPDATE scenariohelp_post AS p
+            SET search_vector = setweight(to_tsvector(%s, q.title), 'A') ||
+                                setweight(to_tsvector(%s, regexp_replace(p.text, '<[^>]*>',
+                                                                         ' ', 'g')), 'B')
+            FROM scenariohelp_question AS q
+            WHERE q.id = p.question_id
+            ''', (SEARCH_CONFIG, SEARCH_CONFIG))
+            return c.rowcount
+        c.execute('DELETE FROM scenariohelp_post_fts')
+
+    num_indexed = 0
+    for post in Post.objects.select_related('question').iterator():
+        index_post(post, post.question)
+        num_indexed += 1
+    return num_indexed
+
+
+def create_fts_table(connection):
+    """Create the FTS5 table of the search index on SQLite if it is missing.
+
+    :param connection: Database connection
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as c:
+        c.execute("SELECT name FROM sqlite_master WHERE name = 'scenariohelp_post_fts'")
+        if c.fetchone():
+            return
+        c.execute("""
+        CREATE VIRTUAL TABLE scenariohelp_post_fts
+        USING fts5(title, text, tokenize='unicode61 remove_diacritics 2')
+        """)
+        # Matches in the title weigh ten times more than in the text
+        c.execute("INSERT INTO scenariohelp_post_fts (scenariohelp_post_fts, rank) "
+                  "VALUES ('rank', 'bm25(10.0, 1.0)')")
@@ -1,15 +1,22 @@
 from django import template
 
-from insekta.scenariohelp.models import Question, get_num_unseen
+from insekta.scenariohelp.models import get_badge_counts
 
 
 register = template.Library()
 
 @register.simple_tag
 def num_new_questions(user):
-    return get_num_unseen(user)
+    return _get_badge_counts(user).num_unseen
 
 
 @register.simple_tag
 def num_new_questions_answered(user):
-    return Question.objects.filter(author=user, seen_by_author=False).count()
\ No newline at end of file
+    return _get_badge_counts(user).num_answered
+
+
+def _get_badge_counts(user):
+    # Both tags are used on every page, fetch the counts only once per request
+    if not hasattr(user, '_badge_counts'):
+        user._badge_counts = get_badge_counts(user)
+    return user._badge_counts
@@ -1,3 +1,237 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+
+from insekta.scenariohelp.models import Question, SupportedScenario, get_badge_counts
+from insekta.scenariohelp.search import rebuild_index, search_questions
+from insekta.scenarios.models import Course, Scenario, ScenarioGroup, ScenarioGroupEntry
+
+
+# Queries of the database cache would be counted by assertNumQueries
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BadgeCountsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.author = User.objects.create(username='author')
+        self.supporter = User.objects.create(username='supporter')
+        self.scenario = Scenario.objects.create(key='test', title='Test')
+        self.course = Course.objects.create(key='course', title='Course')
+        SupportedScenario.objects.create(user=self.supporter, scenario=self.scenario)
+
+    def test_badge_counts(self):
+        self.assertEqual(get_badge_counts(self.supporter), (0, 0))
+        question = Question.objects.create(title='Help', author=self.author,
+                                           scenario=self.scenario, course=self.course)
+        question.post_answer(self.author, 'Question')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_badge_counts(self.supporter), (1, 0))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_badge_counts(self.supporter), (1, 0))
+
+        question.mark_seen(self.supporter)
+        self.assertEqual(get_badge_counts(self.supporter), (0, 0))
+        question.post_answer(self.supporter, 'Answer')
+        self.assertEqual(get_badge_counts(self.author), (0, 1))
+        question.mark_seen(self.author)
+        self.assertEqual(get_badge_counts(self.author), (0, 0))
+
+        question.post_answer(self.author, 'Thanks')
+        self.assertEqual(get_badge_counts(self.supporter), (1, 0))
+        question.mark_seen(self.supporter)
+        with self.assertNumQueries(1):
+            question.mark_seen(self.supporter)
+        self.assertEqual(get_badge_counts(self.supporter), (0, 0))
+
+        SupportedScenario.objects.all().delete()
+        question.post_answer(self.author, 'Question')
+        self.assertEqual(get_badge_counts(self.supporter), (0, 0))
+
+    def test_answer_by_other_supporter(self):
+        other_supporter = get_user_model().objects.create(username='other')
+        SupportedScenario.objects.create(user=other_supporter, scenario=self.scenario)
+        question = Question.objects.create(title='Help', author=self.author,
+                                           scenario=self.scenario, course=self.course)
+        question.post_answer(self.author, 'Question')
+        question.mark_seen(self.supporter)
+        self.assertEqual(get_badge_counts(self.supporter), (0, 0))
+
+        question.post_answer(other_supporter, 'Answer')
+        self.assertEqual(get_badge_counts(self.supporter), (1, 0))
+        self.assertEqual(get_badge_counts(other_supporter), (0, 0))
+        self.client.force_login(self.supporter)
+        response = self.client.get(reverse('scenariohelp:index'))
+        self.assertFalse(response.context['questions'][0].is_seen)
+
+    def test_stale_instance(self):
+        question = Question.objects.create(title='Help', author=self.author,
+                                           scenario=self.scenario, course=self.course)
+        question.post_answer(self.author, 'Question')
+        question.post_answer(self.supporter, 'Answer')
+        stale_question = Question.objects.get(pk=question.pk)
+        post = question.post_answer(self.supporter, 'Another answer')
+        stale_question.mark_seen(self.author)
+        stale_question.mark_solved()
+        question.refresh_from_db()
+        self.assertEqual(question.last_post_id, post.pk)
+        self.assertTrue(question.seen_by_author)
+        self.assertTrue(question.is_solved)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ViewQueriesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.supporter = User.objects.create(username='supporter')
+        self.course = Course.objects.create(key='course', title='Course', enabled=True)
+        self.scenarios = [Scenario.objects.create(key='test{}'.format(i), title='Test',
+                                                  enabled=True)
+                          for i in range(3)]
+        for i, scenario in enumerate(self.scenarios):
+            SupportedScenario.objects.create(user=self.supporter, scenario=scenario)
+            author = User.objects.create(username='author{}'.format(i))
+            question = Question.objects.create(title='Help', author=author,
+                                               scenario=scenario, course=self.course)
+            question.post_answer(author, 'Question')
+            question.post_answer(self.supporter, 'Answer')
+        self.question = question
+        self.client.force_login(self.supporter)
+
+    def test_list_questions(self):
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('scenariohelp:index'))
+        self.assertEqual(len(response.context['questions']), 3)
+
+    def test_view_question(self):
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('scenariohelp:view', args=[self.question.pk]))
+        self.assertEqual(len(response.context['posts']), 2)
+
+    def test_configure_help(self):
+        scenario_group = ScenarioGroup.objects.create(course=self.course, title='Group')
+        for i, scenario in enumerate(self.scenarios):
+            ScenarioGroupEntry.objects.create(scenario_group=scenario_group, scenario=scenario,
+                                              order_id=i)
+        SupportedScenario.objects.filter(scenario__key='test2').delete()
+        other_user = get_user_model().objects.create(username='other')
+        SupportedScenario.objects.create(user=other_user, scenario=self.scenarios[0])
+        post_data = {'course': self.course.pk, 'change_support': '1',
+                     'sc_test1': 'on', 'sc_test2': 'on'}
+        with self.assertNumQueries(10):
+            self.client.post(reverse('scenariohelp:configure_help'), post_data)
+        supported = (SupportedScenario.objects.filter(user=self.supporter)
+                     .values_list('scenario__key', flat=True))
+        self.assertEqual(set(supported), {'test1', 'test2'})
+        self.assertTrue(SupportedScenario.objects.filter(user=other_user).exists())
+
+
+@override_settings(SCENARIOHELP_QUESTIONS_PER_PAGE=2)
+class SolvedQuestionsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create(username='user')
+        self.course = Course.objects.create(key='course', title='Course', enabled=True)
+        self.scenario = Scenario.objects.create(key='test', title='Test', enabled=True)
+        ScenarioGroup.objects.create(course=self.course, title='Group').scenario_objects.add(
+            self.scenario)
+        time_created = now()
+        # Questions with the same time are ordered by id
+        self.questions = [Question.objects.create(title='Help', author=self.user,
+                                                  scenario=self.scenario, course=self.course,
+                                                  time_created=time_created, is_solved=True)
+                          for _i in range(5)][::-1]
+        self.client.force_login(self.user)
+
+    def get_page(self, **params):
+        url = reverse('scenariohelp:scenario_questions', args=['course', 'test'])
+        response = self.client.get(url, params)
+        return response.context['solved_page']
+
+    def test_pages(self):
+        page = self.get_page()
+        self.assertEqual(list(page), self.questions[:2])
+        self.assertFalse(page.has_previous())
+        self.assertEqual(page.paginator.count, 5)
+        page = self.get_page(after=page.next_cursor)
+        self.assertEqual(list(page), self.questions[2:4])
+        page = self.get_page(after=page.next_cursor)
+        self.assertEqual(list(page), self.questions[4:])
+        self.assertFalse(page.has_next())
+        page = self.get_page(before=page.previous_cursor)
+        self.assertEqual(list(page), self.questions[2:4])
+        page = self.get_page(before=page.previous_cursor)
+        self.assertEqual(list(page), self.questions[:2])
+        self.assertFalse(page.has_previous())
+        self.assertEqual(list(self.get_page(after='invalid')), self.questions[:2])
+
+    def test_cached_count(self):
+        self.assertEqual(self.get_page().paginator.count, 5)
+        Question.objects.create(title='Help', author=self.user, scenario=self.scenario,
+                                course=self.course).mark_solved()
+        self.assertEqual(self.get_page().paginator.count, 6)
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create(username='user')
+        self.course = Course.objects.create(key='course', title='Course', enabled=True)
+        self.scenario = Scenario.objects.create(key='sqli', title='SQL', enabled=True)
+        self.other_scenario = Scenario.objects.create(key='xss', title='XSS', enabled=True)
+        self.title_match = self.create_question(self.scenario, 'Injection with UNION',
+                                                '<p>Which columns do I need?</p>')
+        self.text_match = self.create_question(self.scenario, 'Stuck at task 3',
+                                               '<p>My <code>union</code> select fails</p>')
+        self.other_match = self.create_question(self.other_scenario, 'Union of filters',
+                                                '<p>Filter bypass</p>')
+
+    def create_question(self, scenario, title, text):
+        question = Question.objects.create(title=title, author=self.user, scenario=scenario,
+                                           course=self.course)
+        question.post_answer(self.user, text)
+        return question
+
+    def test_search(self):
+        questions = search_questions('union')
+        self.assertEqual(set(questions), {self.title_match, self.text_match, self.other_match})
+        questions = search_questions('union', scenario=self.scenario)
+        self.assertEqual(questions, [self.title_match, self.text_match])
+        self.assertEqual(search_questions('union select'), [self.text_match])
+        self.assertEqual(search_questions('code'), [])
+        self.assertEqual(search_questions('"'), [])
+
+        self.other_match.post_answer(self.user, 'Try a UNION SELECT')
+        self.assertEqual(search_questions('select', scenario=self.other_scenario),
+                         [self.other_match])
+
+    def test_adjacent_elements(self):
+        question = self.create_question(self.scenario, 'Columns', '<p>first</p><p>second</p>')
+        self.assertEqual(search_questions('second'), [question])
+        self.assertEqual(search_questions('firstsecond'), [])
+        self.assertEqual(rebuild_index(), 4)
+        self.assertEqual(search_questions('second'), [question])
+
+    def test_unsupported_database(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            self.assertEqual(search_questions('union'), [])
+            self.assertEqual(rebuild_index(), 0)
+
+    def test_rebuild_index(self):
+        Question.objects.filter(pk=self.text_match.pk).update(title='Stuck at task 4')
+        self.assertEqual(rebuild_index(), 3)
+        self.assertEqual(search_questions('4'), [self.text_match])
+
+    def test_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('scenariohelp:search'),
+                                   {'q': 'union', 'scenario': 'xss'})
+        self.assertEqual(response.context['questions'], [self.other_match])
@@ -11,6 +11,7 @@ urlpatterns = [
     path('scenario_questions/<course_key>/<scenario_key>', views.scenario_questions,
         name='scenario_questions'),
     path('new_question/<course_key>/<scenario_key>', views.new_question, name='new_question'),
+    path('search', views.search, name='search'),
     path('configure', views.configure_help, name='configure_help'),
     path('set_support_scenario/<course_key>/<scenario_key>', views.set_support_scenario,
         name='set_support_scenario'),
@@ -1,30 +1,28 @@
-import copy
-
 from django import forms
 from django.contrib import messages
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator, InvalidPage
+from django.db.models import F
 from django.http import HttpResponse, Http404
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.http import require_POST
 
+from insekta.base.pagination import KeysetPaginator, InvalidCursor
 from insekta.base.utils import describe_allowed_markup, sanitize_markup
-from insekta.scenariohelp.forms import NewQuestionForm
-from insekta.scenariohelp.models import SupportedScenario, Question, SeenQuestion, Post
+from insekta.scenariohelp.forms import NewQuestionForm, SearchForm
+from insekta.scenariohelp.models import (SupportedScenario, Question, SeenQuestion, Post,
+                                         invalidate_badge_counts)
+from insekta.scenariohelp.search import search_questions
 from insekta.scenarios.models import Course, Scenario, ScenarioGroup
 
-NUM_SOLVED_PER_PAGE = 25
-
 
 @login_required
 def list_questions(request):
-
-    supported_scenarios = SupportedScenario.objects.filter(user=request.user)
-    scenario_pks = [s.scenario.pk for s in supported_scenarios]
-
-    questions = (Question.objects.select_related()
-                 .filter(is_solved=False, scenario__pk__in=scenario_pks)
+    supported_scenarios = (SupportedScenario.objects.filter(user=request.user)
+                           .values('scenario_id'))
+    questions = (Question.objects.select_related('author', 'course', 'scenario')
+                 .filter(is_solved=False, scenario__in=supported_scenarios)
                  .order_by('-time_created'))
     questions = list(questions)
     _annotate_is_seen(questions, request.user)
@@ -37,10 +35,11 @@ def list_questions(request):
 
 @login_required
 def my_questions(request):
-    questions = (Question.objects.select_related().filter(author=request.user)
-                 .order_by('-time_created'))
+    questions = (Question.objects.select_related('course', 'scenario')
+                 .filter(author=request.user))
+    paginator = KeysetPaginator(questions, settings.SCENARIOHELP_QUESTIONS_PER_PAGE)
     return render(request, 'scenariohelp/my_questions.html', {
-        'questions': questions,
+        'questions': _get_page(paginator, request),
         'active_nav': 'account'
     })
 
@@ -51,27 +50,26 @@ def scenario_questions(request, course_key, scenario_key):
     course = get_object_or_404(Course, key=course_key)
     if not scenario.is_inside_course(course):
         raise Http404('No such scenario in this course.')
-    unsolved_questions = list(Question.objects.select_related()
+    unsolved_questions = list(Question.objects.select_related('author')
                               .filter(is_solved=False, scenario=scenario)
                               .order_by('-time_created'))
     my_unsolved = []
     others_unsolved = []
     for question in unsolved_questions:
-        if question.author == request.user:
+        if question.author_id == request.user.pk:
             my_unsolved.append(question)
         else:
             others_unsolved.append(question)
 
     _annotate_is_seen(others_unsolved, request.user)
 
-    solved_questions = (Question.objects.select_related()
-                        .filter(is_solved=True, scenario=scenario)
-                        .order_by('-time_created'))
-    paginator = Paginator(solved_questions, per_page=NUM_SOLVED_PER_PAGE)
-    try:
-        solved_page = paginator.page(request.GET.get('page'))
-    except InvalidPage:
-        solved_page = paginator.page(1)
+    solved_questions = (Question.objects.select_related('author')
+                        .filter(is_solved=True, scenario=scenario))
+    paginator = KeysetPaginator(
+        solved_questions, settings.SCENARIOHELP_QUESTIONS_PER_PAGE,
+        count_cache_key=Question.solved_count_cache_key.format(scenario.pk),
+        count_timeout=settings.SCENARIOHELP_COUNT_CACHE_TIMEOUT)
+    solved_page = _get_page(paginator, request)
 
     return render(request, 'scenariohelp/scenario_questions.html', {
         'course': course,
@@ -122,16 +120,16 @@ def new_question(request, course_key, scenario_key):
 
 @login_required
 def view_question(request, question_pk):
-    question = get_object_or_404(Question, pk=question_pk)
+    question = get_object_or_404(Question.objects.select_related('author', 'course', 'scenario'),
+                                 pk=question_pk)
     question.mark_seen(request.user)
-    posts = Post.objects.filter(question=question).select_related()
+    posts = Post.objects.filter(question=question).select_related('author')
 
     answer = ''
     answer_preview = ''
     if request.method == 'POST':
         if 'solve' in request.POST and question.author == request.user:
-            question.is_solved = True
-            question.save()
+            question.mark_solved()
             return redirect('scenariohelp:my_questions')
 
         answer = request.POST.get('answer', '')
@@ -155,6 +153,25 @@ def view_question(request, question_pk):
     })
 
 
+@login_required
+def search(request):
+    questions = None
+    if 'q' in request.GET:
+        form = SearchForm(request.GET)
+        if form.is_valid():
+            questions = search_questions(form.cleaned_data['q'],
+                                         scenario=form.cleaned_data['scenario'],
+                                         course=form.cleaned_data['course'])
+    else:
+        form = SearchForm(initial={'scenario': request.GET.get('scenario')})
+
+    return render(request, 'scenariohelp/search.html', {
+        'form': form,
+        'questions': questions,
+        'active_nav': 'help'
+    })
+
+
 @login_required
 def configure_help(request):
     courses = Course.objects.filter(enabled=True)
@@ -172,34 +189,37 @@ def configure_help(request):
 
     scenario_topics = scenario_challenges = []
     if course:
-        scenario_topics = list(course.scenario_groups.filter(hidden=False).order_by('order_id'))
-        scenario_challenges = copy.deepcopy(scenario_topics)
-        scenario_topics = ScenarioGroup.annotate_list(scenario_topics, is_challenge=False)
-        scenario_challenges = ScenarioGroup.annotate_list(scenario_challenges, is_challenge=True)
+        scenario_topics, scenario_challenges = ScenarioGroup.load_course_groups(course)
         scenarios = []
         for scenario_group in scenario_topics:
             scenarios += scenario_group.scenarios
         for scenario_group in scenario_challenges:
             scenarios += scenario_group.scenarios
 
-        supported_scenarios = SupportedScenario.objects.filter(
-                user=request.user, scenario__in=scenarios)
-        supported_pks = set(supported.scenario.pk for supported in supported_scenarios)
+        supported_pks = set(SupportedScenario.objects
+                            .filter(user=request.user, scenario__in=scenarios)
+                            .values_list('scenario_id', flat=True))
         for scenario in scenarios:
             scenario.is_supported = scenario.pk in supported_pks
         if request.method == 'POST' and 'change_support' in request.POST:
-            disable_support = []
-            enabled_support = []
+            disable_pks = set()
+            enable_pks = set()
             for scenario in scenarios:
-                if 'sc_' + scenario.key in request.POST:
-                    scenario.is_supported = True
-                    enabled_support.append(scenario)
-                else:
-                    scenario.is_supported = False
-                    disable_support.append(scenario)
-            SupportedScenario.objects.filter(scenario__in=disable_support).delete()
-            for scenario in enabled_support:
-                SupportedScenario.objects.get_or_create(user=request.user, scenario=scenario)
+                scenario.is_supported = 'sc_' + scenario.key in request.POST
+                if scenario.is_supported and scenario.pk not in supported_pks:
+                    enable_pks.add(scenario.pk)
+                elif not scenario.is_supported and scenario.pk in supported_pks:
+                    disable_pks.add(scenario.pk)
+            if disable_pks:
+                SupportedScenario.objects.filter(user=request.user,
+                                                 scenario_id__in=disable_pks).delete()
+            if enable_pks:
+                # bulk_create does not send post_save, invalidate the badges here
+                SupportedScenario.objects.bulk_create(
+                    [SupportedScenario(user=request.user, scenario_id=scenario_pk)
+                     for scenario_pk in enable_pks],
+                    ignore_conflicts=True)
+                invalidate_badge_counts([request.user.pk])
             messages.success(request, _('Supported topics/challenges configured successfully.'))
 
     return render(request, 'scenariohelp/configure_help.html', {
@@ -221,11 +241,20 @@ def set_support_scenario(request, course_key, scenario_key):
     return redirect('scenarios:view', course_key, scenario.key)
 
 
+def _get_page(paginator, request):
+    try:
+        return paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
+    except InvalidCursor:
+        return paginator.page()
+
+
 def _annotate_is_seen(question_list, user):
-    seen_questions = SeenQuestion.objects.filter(user=user,
-                                                 question__in=question_list)
-    seen_pks = set(hq.question.pk for hq in seen_questions)
+    seen_pks = set(SeenQuestion.objects
+                   .filter(user=user,
+                           question__in=question_list,
+                           last_seen_post_id__gte=F('question__last_post_id'))
+                   .values_list('question_id', flat=True))
     for question in question_list:
-        question.is_seen = question.pk in seen_pks or question.author == user
+        question.is_seen = question.pk in seen_pks or question.author_id == user.pk
 
     return question_list
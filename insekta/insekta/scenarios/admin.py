@@ -4,7 +4,7 @@ from django.utils.safestring import mark_safe
 from insekta.scenarios.models import (Scenario, ScenarioGroup, ScenarioGroupEntry,
                                       Task, CommentId, Comment, Course, CourseRun,
                                       TaskConfiguration, TaskGroup, TaskSolve,
-                                      TaskSolveArchive)
+                                      TaskSolveArchive, ScenarioProgress)
 
 
 class ScenarioAdmin(admin.ModelAdmin):
@@ -116,6 +116,11 @@ class TaskSolveArchiveAdmin(admin.ModelAdmin):
     list_display = ('task', 'user', 'course_run', 'is_correct')
 
 
+class ScenarioProgressAdmin(admin.ModelAdmin):
+    list_display = ('scenario', 'user', 'num_solved')
+    list_filter = ('scenario__title', )
+
+
 admin.site.register(Scenario, ScenarioAdmin)
 admin.site.register(ScenarioGroup, ScenarioGroupAdmin)
 admin.site.register(Task, TaskAdmin)
@@ -127,3 +132,4 @@ admin.site.register(TaskConfiguration, TaskConfigurationAdmin)
 admin.site.register(TaskGroup, TaskGroupAdmin)
 admin.site.register(TaskSolve, TaskSolveAdmin)
 admin.site.register(TaskSolveArchive, TaskSolveArchiveAdmin)
+admin.site.register(ScenarioProgress, ScenarioProgressAdmin)
@@ -0,0 +1,147 @@
+import threading
+
+from django.conf import settings
+from django.utils import translation
+from jinja2 import nodes
+
+
+__all__ = ['FragmentTemplate', 'STATIC_NAMES', 'FILE_ARGUMENTS']
+
+
+# Template functions whose output is the same for every user
+STATIC_NAMES = frozenset(['media', 'code', 'hint'])
+
+# Names which are local to a node of the template
+_LOCAL_NAMES = frozenset(['caller', 'loop', 'varargs', 'kwargs'])
+
+# Template functions which read a file given by a keyword argument
+FILE_ARGUMENTS = {'code': 'filename'}
+
+# Top-level nodes which affect the rest of the template
+_GLOBAL_NODES = (nodes.Macro, nodes.Assign, nodes.AssignBlock, nodes.Import, nodes.FromImport,
+                 nodes.Extends, nodes.Block, nodes.Include)
+
+
+class FragmentTemplate:
+    """A scenario template split into static and dynamic parts.
+
+    The top-level nodes of the template are grouped into static parts,
+    which only use static template functions like code and media, and
+    dynamic parts, which use functions depending on the user like task and
+    script_values. Static parts are rendered once per language and reused
+    for all users, only the dynamic parts are rendered for every request.
+
+    Templates defining macros, variables or blocks on the top level are
+    not split and rendered as a whole. Parts reading files, like
+    code(filename=...), are dynamic, since the files can change without
+    the template. The constant filenames they read are collected in
+    included_files.
+    """
+
+    def __init__(self, environment, ast, name, filename):
+        self.name = name
+        self.filename = filename
+        self.included_files = frozenset(_find_included_files(ast))
+        self._parts = []
+        self._static_outputs = {}
+        self._lock = threading.Lock()
+
+        if any(isinstance(node, _GLOBAL_NODES) for node in ast.body):
+            groups = [(False, ast.body)]
+        else:
+            groups = []
+            for node in _flatten(ast.body):
+                is_static = _is_static(node, environment)
+                if groups and groups[-1][0] == is_static:
+                    groups[-1][1].append(node)
+                else:
+                    groups.append((is_static, [node]))
+        for is_static, body in groups:
+            template_node = nodes.Template(body, lineno=1)
+            code = environment.compile(template_node, name, filename)
+            template = environment.template_class.from_code(
+                environment, code, environment.make_globals(None))
+            self._parts.append((is_static, template))
+
+    @property
+    def num_static_parts(self):
+        return sum(1 for is_static, _template in self._parts if is_static)
+
+    def render(self, context=None):
+        """Render the template.
+
+        :param context: Dictionary with the template functions and values
+        :return: str with the rendered template
+        """
+        return ''.join(self.generate(context))
+
+    def generate(self, context=None):
+        """Render the template part by part.
+
+        :param context: Dictionary with the template functions and values
+        :return: Iterator of str
+        """
+        if context is None:
+            context = {}
+        static_outputs = self._get_static_outputs(context)
+        for i, (is_static, template) in enumerate(self._parts):
+            if is_static:
+                yield static_outputs[i]
+            else:
+                yield template.render(context)
+
+    def _get_static_outputs(self, context):
+        language = translation.get_language()
+        static_outputs = self._static_outputs.get(language)
+        if static_outputs is None:
+            # Static parts are only rendered once, even if several threads
+            # render the template for the first time.
+            with self._lock:
+                static_outputs = self._static_outputs.get(language)
+                if static_outputs is None:
+                    static_outputs = {i: template.render(context)
+                                      for i, (is_static, template) in enumerate(self._parts)
+                                      if is_static}
+                    # Files included with code() are read again in debug mode
+                    if not settings.DEBUG:
+                        self._static_outputs[language] = static_outputs
+        return static_outputs
+
+
+def _flatten(body):
+    for node in body:
+        if isinstance(node, nodes.Output):
+            for child in node.nodes:
+                yield nodes.Output([child], lineno=child.lineno)
+        else:
+            yield node
+
+
+def _find_included_files(node):
+    for call in node.find_all(nodes.Call):
+        argument = _get_file_argument(call)
+        if argument is not None and isinstance(argument.value, nodes.Const):
+            yield argument.value.value
+
+
+def _get_file_argument(call):
+    if not isinstance(call.node, nodes.Name) or call.node.name not in FILE_ARGUMENTS:
+        return None
+    for keyword in call.kwargs:
+        if keyword.key == FILE_ARGUMENTS[call.node.name]:
+            return keyword
+    return None
+
+
+def _is_static(node, environment):
+    if any(_get_file_argument(call) is not None for call in node.find_all(nodes.Call)):
+        return False
+    local_names = set(_LOCAL_NAMES)
+    loaded_names = set()
+    for name_node in node.find_all(nodes.Name):
+        if name_node.ctx == 'load':
+            loaded_names.add(name_node.name)
+        else:
+            local_names.add(name_node.name)
+    allowed_names = STATIC_NAMES | local_names | set(environment.globals)
+    return loaded_names <= allowed_names
@@ -0,0 +1,107 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import namedtuple
+
+import pygments
+from django.conf import settings
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+
+from insekta.base.cache import LRUCache
+from insekta.scenarios.dsl.templateloader import stat_cache
+
+
+__all__ = ['highlight_code', 'read_lines']
+
+
+logger = logging.getLogger(__name__)
+
+FileLines = namedtuple('FileLines', ['mtime', 'lines'])
+
+_highlight_cache = LRUCache(settings.SCENARIO_HIGHLIGHT_CACHE_SIZE, weigh=len)
+_file_lines = LRUCache(256)
+
+
+def highlight_code(source_code, language, linenos=True, linestart=1, stripall=False,
+                   stripnl=True):
+    """Highlight source code as HTML.
+
+    The HTML is cached under a hash of the source code, the options and
+    the Pygments version, in memory and optionally in
+    SCENARIO_HIGHLIGHT_CACHE_DIR.
+
+    :return: str with the highlighted code
+    """
+    key_data = [source_code, language, linenos, linestart, stripall, stripnl,
+                pygments.__version__]
+    key = hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+    html = _highlight_cache.get(key)
+    if html is None:
+        html = _read_cache_file(key)
+        if html is None:
+            lexer = _get_lexer(language, stripall, stripnl)
+            formatter = _get_formatter(linenos, linestart)
+            html = pygments.highlight(source_code, lexer, formatter)
+            _write_cache_file(key, html)
+        _highlight_cache.set(key, html)
+    return html
+
+
+def read_lines(filename):
+    """Return the lines of a file, cached until the file is modified.
+
+    :param filename: Absolute path to the file
+    :return: Tuple of lines including line endings
+    """
+    mtime = stat_cache.get_mtime(filename)
+    file_lines = _file_lines.get(filename)
+    if file_lines is None or mtime is None or file_lines.mtime != mtime:
+        with open(filename) as f:
+            file_lines = FileLines(mtime, tuple(f.readlines()))
+        _file_lines.set(filename, file_lines)
+    return file_lines.lines
+
+
+@functools.lru_cache(maxsize=64)
+def _get_lexer(language, stripall, stripnl):
+    return get_lexer_by_name(language, stripall=stripall, stripnl=stripnl)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_formatter(linenos, linestart):
+    return HtmlFormatter(linenos=linenos, linenostart=linestart)
+
+
+def _get_cache_filename(key):
+    return os.path.join(settings.SCENARIO_HIGHLIGHT_CACHE_DIR, key[:2], key + '.html')
+
+
+def _read_cache_file(key):
+    if not settings.SCENARIO_HIGHLIGHT_CACHE_DIR:
+        return None
+    try:
+        with open(_get_cache_filename(key), encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning('Could not read highlight cache file: %s', e)
+        return None
+
+
+def _write_cache_file(key, html):
+    if not settings.SCENARIO_HIGHLIGHT_CACHE_DIR:
+        return
+    filename = _get_cache_filename(key)
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        logger.warning('Could not write highlight cache file: %s', e)
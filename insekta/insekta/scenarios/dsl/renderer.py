@@ -1,30 +1,39 @@
 import functools
-import hmac
+import hashlib
 import io
+import json
 import os
+import time
 from collections import namedtuple
 
 from django.conf import settings
 from django.urls import reverse
-from django.utils import html
+from django.utils import html, translation
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext as _
-from jinja2 import Environment
+from jinja2 import Environment, TemplateNotFound
 from markupsafe import escape
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_by_name
 
+from insekta.base.cache import LRUCache
+from insekta.scenarios.dsl.fragments import FragmentTemplate
+from insekta.scenarios.dsl.highlighting import highlight_code, read_lines
+from insekta.scenarios.dsl.scriptloader import get_scripts_version
 from insekta.scenarios.dsl.scripts import ScriptInputValidationError
-from insekta.scenarios.dsl.templateloader import ScenarioTemplateLoader
-from insekta.scenarios.models import Task, TaskSolve
+from insekta.scenarios.dsl.tasks import get_mac_table
+from insekta.scenarios.dsl.templateloader import ScenarioTemplateLoader, stat_cache
+from insekta.scenarios.models import ScenarioProgress, Task, TaskSolve
 
 
-__all__ = ['Renderer']
+__all__ = ['Renderer', 'generate_scenario', 'get_scenario_template', 'render_scenario']
 
 
 SubmitResult = namedtuple('SubmitResult', ['is_correct', 'task', 'answer'])
 
+OutputCacheEntry = namedtuple('OutputCacheEntry', ['output', 'expires_at'])
+
+# Rendered scenarios are cached with this placeholder instead of the csrf token
+CSRF_TOKEN_PLACEHOLDER = '__insekta_csrf_token__'
+
 
 def collect_to_str(fn):
     def _wrap(*args, **kwargs):
@@ -46,10 +55,6 @@ class Renderer:
         self.vpn_ip = vpn_ip
         self.template_tasks = scenario.get_template_tasks()
 
-        self.env = Environment(loader=_template_loader)
-        for fn_name, fn in self._get_template_functions().items():
-            self.env.globals[fn_name] = fn
-
         self._solved_task_answers = {}
         tasks = Task.objects.filter(scenario=scenario)
         solves = TaskSolve.objects.filter(user=user, task__in=tasks).select_related('task')
@@ -62,6 +67,7 @@ class Renderer:
         self.validation_error_message = None
         self.validation_context = {}
         self._current_task_identifier = ''
+        self._script_values = {}
 
     @collect_to_str
     def _call_task(self, identifier, title=None, caller=None, **kwargs):
@@ -183,17 +189,14 @@ class Renderer:
             source_code = caller()
         elif filename is not None:
             scenario_dir = os.path.join(settings.SCENARIO_DIR, self.scenario.key)
-            with open(os.path.join(scenario_dir, filename)) as f:
-                lines = f.readlines()
+            lines = read_lines(os.path.join(scenario_dir, filename))
             if lineend is None:
                 lineend = len(lines)
             source_code = ''.join(lines[linestart - 1:lineend])
 
-        lexer = get_lexer_by_name(language,
-                                  stripall=True if caller else False,
-                                  stripnl=False if filename else True)
-        formatter = HtmlFormatter(linenos=linenos, linenostart=linestart)
-        return highlight(source_code, lexer, formatter)
+        return highlight_code(source_code, language, linenos, linestart,
+                              stripall=True if caller else False,
+                              stripnl=False if filename else True)
 
     @collect_to_str
     def _call_hint(self, caller):
@@ -254,8 +257,11 @@ class Renderer:
             return '<input {}/>'.format(attrs_str)
 
     def _call_script_values(self):
-        task = self._get_current_task()
-        return task.get_values(self.user)
+        identifier = self._current_task_identifier
+        if identifier not in self._script_values:
+            task = self._get_current_task()
+            self._script_values[identifier] = task.get_values(self.user)
+        return self._script_values[identifier]
 
     def _call_validation_context(self):
         return self.validation_context
@@ -299,6 +305,17 @@ class Renderer:
         :param context: Dictionary with additional template values
         :return: str with the rendered template
         """
+        return mark_safe(''.join(self.generate(context)))
+
+    def generate(self, context=None):
+        """Renders the scenario template part by part.
+
+        The template is loaded before returning, so template errors are
+        raised by this call and not while iterating.
+
+        :param context: Dictionary with additional template values
+        :return: Iterator of str
+        """
         if context is None:
             context = {}
         context.update({
@@ -308,7 +325,8 @@ class Renderer:
             'vms': self.virtual_machines,
             'vpn_ip': self.vpn_ip
         })
-        return mark_safe(self.env.get_template(self.scenario.key).render(**context))
+        context.update(self._get_template_functions())
+        return get_scenario_template(self.scenario).generate(context)
 
     def submit(self, form_values):
         """Submits a form for the given scenario and validates it.
@@ -321,25 +339,119 @@ class Renderer:
         except KeyError:
             return False
 
-        for tpl_task in self.template_tasks.values():
-            if hmac.compare_digest(tpl_task.get_mac(self.user, self.scenario), task_mac):
-                self.submitted_values = tpl_task.extract_values(self.user,
-                                                                self.scenario,
-                                                                form_values)
-                self.submitted_task = tpl_task
-                try:
-                    # The validate function can either return False to signal
-                    # an invalid answer or it can raise a ScriptInputValidationError
-                    # which may contain a message explaining the user's mistake.
-                    if not tpl_task.validate(self.submitted_values, self.validation_context):
-                        raise ScriptInputValidationError()
-                except ScriptInputValidationError as e:
-                    self.validation_error_message = e.message
-                else:
-                    self.submitted_valid = True
-                    self._solved_task_answers[tpl_task.identifier] = self.submitted_values
-                    return SubmitResult(True, tpl_task, self.submitted_values)
+        tpl_task = get_mac_table(self.user, self.scenario).find_task(self.template_tasks,
+                                                                     task_mac)
+        if tpl_task is None:
+            return SubmitResult(False, None, None)
+
+        self.submitted_values = tpl_task.extract_values(self.user,
+                                                        self.scenario,
+                                                        form_values)
+        self.submitted_task = tpl_task
+        try:
+            # The validate function can either return False to signal
+            # an invalid answer or it can raise a ScriptInputValidationError
+            # which may contain a message explaining the user's mistake.
+            if not tpl_task.validate(self.submitted_values, self.validation_context):
+                raise ScriptInputValidationError()
+        except ScriptInputValidationError as e:
+            self.validation_error_message = e.message
+        else:
+            self.submitted_valid = True
+            self._solved_task_answers[tpl_task.identifier] = self.submitted_values
+            return SubmitResult(True, tpl_task, self.submitted_values)
         return SubmitResult(False, None, None)
 
 
-_template_loader = ScenarioTemplateLoader(settings.SCENARIO_DIR)
+def get_scenario_template(scenario):
+    """Returns the compiled template of a scenario.
+
+    Compiled templates are shared between all renderers of a worker process
+    and are recompiled once the template file was modified. The template
+    functions depend on the user and are passed as context on rendering,
+    therefore the same compiled template can be used for all users.
+
+    :param scenario: Scenario object
+    :return: FragmentTemplate
+    """
+    mtime = stat_cache.get_mtime(scenario.get_template_filename())
+    if mtime is None:
+        raise TemplateNotFound(scenario.key)
+    return _template_cache.get_or_create((scenario.key, mtime),
+                                         lambda: _compile_template(scenario.key))
+
+
+def render_scenario(course, scenario, user, csrf_token, virtual_machines, vpn_ip):
+    """Renders a scenario which is viewed without submitting a task.
+
+    The output is cached until the template, the scripts or files included
+    with code(filename=...) change, the user solves or resets tasks or the
+    vms change. On a cache hit no Renderer
+    is created. Submissions must use Renderer directly, because the output
+    depends on the submitted values.
+
+    :return: str with the rendered template
+    """
+    return mark_safe(''.join(generate_scenario(course, scenario, user, csrf_token,
+                                               virtual_machines, vpn_ip)))
+
+
+def generate_scenario(course, scenario, user, csrf_token, virtual_machines, vpn_ip):
+    """Like render_scenario, but returns the output part by part.
+
+    The output is added to the cache once it was completely consumed.
+
+    :return: Iterator of str
+    """
+    key = _get_output_cache_key(course, scenario, user, virtual_machines, vpn_ip)
+    entry = _output_cache.get(key)
+    if entry is not None and entry.expires_at >= time.monotonic():
+        return iter([entry.output.replace(CSRF_TOKEN_PLACEHOLDER, csrf_token)])
+    renderer = Renderer(course, scenario, user, CSRF_TOKEN_PLACEHOLDER, virtual_machines, vpn_ip)
+    return _cache_output(key, renderer.generate(), csrf_token)
+
+
+def _cache_output(key, parts, csrf_token):
+    output = []
+    for part in parts:
+        output.append(part)
+        yield part.replace(CSRF_TOKEN_PLACEHOLDER, csrf_token)
+    entry = OutputCacheEntry(''.join(output),
+                             time.monotonic() + settings.SCENARIO_OUTPUT_CACHE_TIMEOUT)
+    _output_cache.set(key, entry)
+
+
+def _get_output_cache_key(course, scenario, user, virtual_machines, vpn_ip):
+    num_solved, version = ScenarioProgress.get_state(user, scenario)
+    # Files read with a filename which is not a constant are not part of
+    # the key, changes to them show up after SCENARIO_OUTPUT_CACHE_TIMEOUT.
+    scenario_dir = os.path.join(settings.SCENARIO_DIR, scenario.key)
+    included_files = sorted(get_scenario_template(scenario).included_files)
+    key_data = [
+        scenario.key,
+        stat_cache.get_mtime(scenario.get_template_filename()),
+        get_scripts_version(scenario.get_scripts_filename()),
+        [(filename, stat_cache.get_mtime(os.path.join(scenario_dir, filename)))
+         for filename in included_files],
+        course.pk,
+        user.pk,
+        num_solved,
+        version,
+        virtual_machines,
+        vpn_ip,
+        translation.get_language(),
+    ]
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _compile_template(name):
+    source, filename, _uptodate = _template_loader.get_source(_env, name)
+    ast = _env.parse(source, name, filename)
+    return FragmentTemplate(_env, ast, name, filename)
+
+
+_template_loader = ScenarioTemplateLoader()
+# Caching is done by _template_cache, which knows about file modifications
+_env = Environment(loader=_template_loader, cache_size=0)
+_template_cache = LRUCache(settings.SCENARIO_TEMPLATE_CACHE_SIZE)
+_output_cache = LRUCache(settings.SCENARIO_OUTPUT_CACHE_SIZE, weigh=lambda entry: len(entry.output))
@@ -0,0 +1,130 @@
+import hashlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import os
+import re
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from insekta.base.cache import LRUCache, SingleFlight
+from insekta.scenarios.dsl.templateloader import stat_cache
+
+
+__all__ = ['ScenarioModuleFinder', 'load_script_classes', 'get_scripts_version']
+
+
+ScriptVersion = namedtuple('ScriptVersion', ['mtime', 'version'])
+
+
+class ScenarioModuleFinder(importlib.abc.MetaPathFinder):
+    """Finds the modules next to the scripts.py which is currently loaded.
+
+    While a scripts.py is executed, its top-level imports are also looked
+    up in its directory, after all other finders. This replaces appending
+    the directory to sys.path, which is not thread-safe.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def search(self, dirname):
+        dirs = self._local.__dict__.setdefault('dirs', [])
+        dirs.append(dirname)
+        try:
+            yield
+        finally:
+            dirs.pop()
+
+    def find_spec(self, fullname, path, target=None):
+        dirs = getattr(self._local, 'dirs', None)
+        if not dirs or path is not None:
+            return None
+        return importlib.machinery.PathFinder.find_spec(fullname, [dirs[-1]])
+
+
+_finder = ScenarioModuleFinder()
+sys.meta_path.append(_finder)
+
+_script_modules = LRUCache(settings.SCENARIO_SCRIPT_CACHE_SIZE)
+_loading = SingleFlight()
+_script_versions = {}
+
+
+def load_script_classes(scripts_filename):
+    """Load the script classes of a scenario's scripts.py.
+
+    The file is imported as a module, with its bytecode cached in
+    __pycache__. Loaded modules are kept until the content of the file
+    changes or they are evicted by more recently used scenarios.
+
+    :param scripts_filename: Absolute path to scripts.py
+    :return: Dict mapping script names to script classes, empty if the
+             scenario has no scripts.py
+    """
+    version = get_scripts_version(scripts_filename)
+    if version is None:
+        return {}
+    key = (scripts_filename, version)
+    script_classes = _script_modules.get(key)
+    if script_classes is not None:
+        return script_classes
+
+    module_name = _get_module_name(scripts_filename)
+    with _loading.lock(module_name):
+        script_classes = _script_modules.get(key)
+        if script_classes is None:
+            script_classes = _import_script_classes(module_name, scripts_filename)
+            _script_modules.set(key, script_classes)
+        return script_classes
+
+
+def get_scripts_version(scripts_filename):
+    """Return the SHA-256 hex digest of a scenario's scripts.py.
+
+    The digest is only recomputed when the modification time changes.
+
+    :param scripts_filename: Absolute path to scripts.py
+    :return: str or None if the file does not exist
+    """
+    mtime = stat_cache.get_mtime(scripts_filename)
+    if mtime is None:
+        return None
+    script_version = _script_versions.get(scripts_filename)
+    if script_version and script_version.mtime == mtime:
+        return script_version.version
+    try:
+        with open(scripts_filename, 'rb') as f:
+            version = hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
+    _script_versions[scripts_filename] = ScriptVersion(mtime, version)
+    return version
+
+
+def _get_module_name(scripts_filename):
+    scenario_key = os.path.basename(os.path.dirname(scripts_filename))
+    return 'insekta_scenario_scripts_{}'.format(re.sub(r'\W', '_', scenario_key))
+
+
+def _import_script_classes(module_name, scripts_filename):
+    loader = importlib.machinery.SourceFileLoader(module_name, scripts_filename)
+    spec = importlib.util.spec_from_file_location(module_name, scripts_filename, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    # Scenario scripts have always been able to use sys without importing it
+    module.sys = sys
+    sys.modules[module_name] = module
+    try:
+        with _finder.search(os.path.dirname(os.path.abspath(scripts_filename))):
+            loader.exec_module(module)
+    finally:
+        sys.modules.pop(module_name, None)
+    try:
+        return module.script_classes
+    except AttributeError:
+        raise ValueError('{} is missing script_classes'.format(scripts_filename))
@@ -0,0 +1,231 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+from inspect import signature
+
+from django.conf import settings
+from django.utils import translation
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from insekta.scenarios.dsl.scriptloader import load_script_classes
+from insekta.scenarios.dsl.scripts import ScriptInputValidationError
+
+
+__all__ = ['ScriptError', 'ScriptNotFound', 'ScriptTimeout', 'InlineScriptRunner',
+           'ScriptPool', 'call_script', 'script_runner']
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScriptError(Exception):
+    pass
+
+
+class ScriptNotFound(ScriptError):
+    pass
+
+
+class ScriptTimeout(ScriptError):
+    pass
+
+
+def call_script(scenario, script_name, seed, task_identifier, method, *args):
+    """Call a method of a scenario script.
+
+    :param scenario: Scenario object
+    :param script_name: Name of the script class in script_classes
+    :param seed: Seed of the script instance, usually the user's pk
+    :param task_identifier: Identifier of the task using the script
+    :param method: One of 'generate', 'validate' and 'download'
+    :param args: Arguments of the method
+    :return: Return value of the method. For validate, a tuple
+             (is_valid, validation_context).
+    """
+    request = (method, scenario.get_scripts_filename(), script_name, seed,
+               task_identifier, args, translation.get_language())
+    return script_runner.call(request)
+
+
+def _run_script(method, scripts_filename, script_name, seed, task_identifier, args):
+    try:
+        class_obj = load_script_classes(scripts_filename)[script_name]
+    except KeyError:
+        raise ScriptNotFound('No such script: {}'.format(script_name))
+    instance = class_obj(seed, task_identifier)
+
+    if method == 'generate':
+        return instance.generate()
+    elif method == 'validate':
+        values, validation_context = args
+        if len(signature(instance.validate).parameters) == 2:
+            is_valid = instance.validate(values, validation_context)
+        else:
+            is_valid = instance.validate(values)
+        return is_valid, validation_context
+    elif method == 'download':
+        if not hasattr(instance, 'download'):
+            return None
+        return instance.download(*args)
+    raise ScriptError('Invalid script method: {}'.format(method))
+
+
+class InlineScriptRunner:
+    """Runs scenario scripts inside the calling process."""
+
+    def call(self, request):
+        method, scripts_filename, script_name, seed, task_identifier, args, _language = request
+        return _run_script(method, scripts_filename, script_name, seed, task_identifier, args)
+
+
+class ScriptPool:
+    """Runs scenario scripts in a pool of worker processes.
+
+    Each call is sent to an idle worker as a tuple over a pipe. If a call
+    takes longer than timeout seconds, the worker is killed and replaced.
+    The address space of the workers is limited to memory_limit bytes.
+    Workers are started on the first call.
+    """
+    startup_timeout = 60
+
+    def __init__(self, num_workers, timeout, memory_limit=None):
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._context = multiprocessing.get_context('spawn')
+        self._idle_workers = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def call(self, request):
+        self._start()
+        worker = self._idle_workers.get()
+        try:
+            if not worker.wait_ready(self.startup_timeout):
+                worker = self._restart(worker)
+                raise ScriptError('Script worker did not start')
+            worker.conn.send(request)
+            if not worker.conn.poll(self.timeout):
+                logger.warning('Script call %s of %s timed out', request[0], request[1])
+                worker = self._restart(worker)
+                raise ScriptTimeout('Script did not finish within {} seconds'.format(
+                    self.timeout))
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            logger.warning('Script worker crashed during call %s of %s', request[0], request[1])
+            worker = self._restart(worker)
+            raise ScriptError('Script worker crashed')
+        finally:
+            self._idle_workers.put(worker)
+
+        if status == 'ok':
+            return value
+        elif status == 'invalid':
+            raise ScriptInputValidationError(value)
+        elif status == 'not_found':
+            raise ScriptNotFound(value)
+        raise ScriptError(value)
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    self._idle_workers.get_nowait().stop()
+                except queue.Empty:
+                    break
+            self._started = False
+
+    def _start(self):
+        if self._started:
+            return
+        with self._lock:
+            if not self._started:
+                for _i in range(self.num_workers):
+                    self._idle_workers.put(_Worker(self._context, self.memory_limit))
+                self._started = True
+
+    def _restart(self, worker):
+        worker.stop()
+        return _Worker(self._context, self.memory_limit)
+
+
+class _Worker:
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_limit),
+                                       name='scenario-script-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        if not self.ready and self.conn.poll(timeout):
+            self.ready = self.conn.recv() == 'ready'
+        return self.ready
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def _worker_main(conn, memory_limit):
+    import django
+    django.setup()
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    _preload_scripts()
+    conn.send('ready')
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        response = _handle_request(request)
+        try:
+            conn.send(response)
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+
+
+def _handle_request(request):
+    method, scripts_filename, script_name, seed, task_identifier, args, language = request
+    with translation.override(language):
+        try:
+            result = _run_script(method, scripts_filename, script_name, seed,
+                                 task_identifier, args)
+        except ScriptInputValidationError as e:
+            return 'invalid', None if e.message is None else str(e.message)
+        except ScriptNotFound as e:
+            return 'not_found', str(e)
+        except Exception:
+            return 'error', traceback.format_exc()
+    return 'ok', result
+
+
+def _preload_scripts():
+    try:
+        scenario_keys = os.listdir(settings.SCENARIO_DIR)
+    except OSError:
+        return
+    for scenario_key in scenario_keys:
+        try:
+            load_script_classes(os.path.join(settings.SCENARIO_DIR, scenario_key, 'scripts.py'))
+        except Exception:
+            logger.exception('Could not preload scripts of %s', scenario_key)
+
+
+if settings.SCENARIO_SCRIPT_WORKERS:
+    script_runner = ScriptPool(settings.SCENARIO_SCRIPT_WORKERS,
+                               settings.SCENARIO_SCRIPT_TIMEOUT,
+                               settings.SCENARIO_SCRIPT_MEMORY_LIMIT)
+else:
+    script_runner = InlineScriptRunner()
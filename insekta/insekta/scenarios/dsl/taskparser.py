@@ -1,11 +1,15 @@
 import re
+from types import MappingProxyType
 
+from django.conf import settings
 from jinja2 import Environment, nodes
 
+from insekta.base.cache import LRUCache
 from insekta.scenarios.dsl.tasks import Choice, TemplateTaskError, task_classes
+from insekta.scenarios.dsl.templateloader import stat_cache
 
 
-__all__ = ['ParserError', 'TaskParser']
+__all__ = ['ParserError', 'TaskParser', 'get_template_tasks']
 
 
 class ParserError(Exception):
@@ -138,7 +142,39 @@ class TaskParser:
 
     @classmethod
     def from_filename(cls, filename, scenario):
-        env = Environment()
         with open(filename) as f:
             template_source = f.read()
-        return cls(env.parse(template_source), scenario)
+        return cls(_parse_env.parse(template_source), scenario)
+
+
+def get_template_tasks(filename, scenario):
+    """Returns the tasks of a scenario template.
+
+    The template is only parsed once per modification of the file. The
+    returned mapping and its tasks are shared between requests and threads
+    and must not be modified.
+
+    :param filename: Path to the scenario template
+    :param scenario: Scenario object
+    :return: Read-only mapping of task identifiers to TemplateTask objects
+    """
+    mtime = stat_cache.get_mtime(filename)
+    if mtime is None:
+        raise FileNotFoundError(filename)
+
+    def parse():
+        tasks = TaskParser.from_filename(filename, scenario).get_tasks()
+        return MappingProxyType(tasks)
+
+    return _task_cache.get_or_create((scenario.pk, filename, mtime), parse)
+
+
+def _count_objects(tasks):
+    num_objects = 0
+    for task in tasks.values():
+        num_objects += 1 + len(getattr(task, 'choices', ())) + len(getattr(task, 'answers', ()))
+    return num_objects
+
+
+_parse_env = Environment()
+_task_cache = LRUCache(settings.SCENARIO_TASK_CACHE_SIZE, weigh=_count_objects)
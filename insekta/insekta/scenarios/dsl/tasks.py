@@ -1,18 +1,21 @@
 import base64
 import hashlib
 import hmac
-from inspect import signature
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from nacl.secret import SecretBox
 from nacl.exceptions import CryptoError
 
+from insekta.base.cache import LRUCache
+from insekta.scenarios.dsl.scriptloader import get_scripts_version
+from insekta.scenarios.dsl.scriptpool import ScriptError, ScriptNotFound, call_script
 from insekta.scenarios.dsl.scripts import ScriptInputValidationError
 
 
 __all__ = ['TemplateTaskError', 'TemplateTask', 'MultipleChoiceTask', 'Choice',
-           'QuestionTask', 'task_classes']
+           'QuestionTask', 'task_classes', 'MacTable', 'get_mac_table']
 
 
 class TemplateTaskError(Exception):
@@ -36,9 +39,7 @@ class TemplateTask:
         raise NotImplemented
 
     def get_mac(self, user, scenario):
-        mac_msg = 'templatetask:{}:{}:{}'.format(user.pk, scenario.pk, self.identifier)
-        return hmac.new(settings.SECRET_KEY.encode(), mac_msg.encode(),
-                        hashlib.sha256).hexdigest()
+        return get_mac_table(user, scenario).get_task_mac(self.identifier)
 
 
 class MultipleChoiceTask(TemplateTask):
@@ -111,9 +112,7 @@ class Choice:
         self.correct = correct
 
     def get_mac(self, user, scenario, task_identifier):
-        mac_msg = 'choice:{}:{}:{}:{}'.format(user.pk, scenario.pk, task_identifier, self.name)
-        return hmac.new(settings.SECRET_KEY.encode(), mac_msg.encode(),
-                        hashlib.sha256).hexdigest()
+        return get_mac_table(user, scenario).get_choice_mac(task_identifier, self.name)
 
     def __repr__(self):
         return '{}(name={!r}, correct={!r})'.format(self.__class__.__name__,
@@ -186,26 +185,39 @@ class ScriptTask(TemplateTask):
         return values
 
     def validate(self, values, validation_context):
-        script_instance = self._get_script_instance(values['_seed'])
-        if len(signature(script_instance.validate).parameters) == 2:
-            is_valid = script_instance.validate(values, validation_context)
-        else:
-            is_valid = script_instance.validate(values)
+        is_valid, new_context = self._call_script(values['_seed'], 'validate',
+                                                  values, validation_context)
+        validation_context.update(new_context)
         if not is_valid:
             raise ScriptInputValidationError(None)
         return is_valid
 
     def get_values(self, user):
-        script_instance = self._get_script_instance(user.pk)
-        return script_instance.generate()
+        """Return the values generated by the script for the user.
+
+        The values are cached per version of scripts.py, so changing the
+        scripts invalidates them.
+        """
+        version = get_scripts_version(self.scenario.get_scripts_filename())
+        if version is None:
+            return self._call_script(user.pk, 'generate')
+        key = 'scriptvalues:{}:{}:{}:{}:{}'.format(self.scenario.key, version, self.script_name,
+                                                  user.pk, self.identifier)
+        values = cache.get(key)
+        if values is None:
+            values = self._call_script(user.pk, 'generate')
+            cache.set(key, values, settings.SCENARIO_SCRIPT_VALUES_CACHE_TIMEOUT)
+        return values
 
-    def _get_script_instance(self, seed):
-        script_classes = self.scenario.get_script_classes()
+    def _call_script(self, seed, method, *args):
         try:
-            class_obj = script_classes[self.script_name]
-        except KeyError:
+            return call_script(self.scenario, self.script_name, seed, self.identifier,
+                               method, *args)
+        except ScriptNotFound:
             raise TemplateTaskError('No such script: {}'.format(self.script_name))
-        return class_obj(seed, self.identifier)
+        except ScriptError as e:
+            # Timeouts and crashed workers are shown like other task errors
+            raise TemplateTaskError('Script {} failed: {}'.format(self.script_name, e)) from e
 
     def get_download_key(self, user, filename):
         box = ScriptTask.get_secretbox()
@@ -240,6 +252,74 @@ class ScriptTask(TemplateTask):
         return SecretBox(key)
 
 
+class MacTable:
+    """Memoized MACs of the tasks and choices of a scenario for a single user.
+
+    The MACs are computed from a copy of a precomputed HMAC state, which
+    already contains the key. Task MACs can be looked up in reverse to find
+    the submitted task.
+    """
+
+    def __init__(self, keyed_hmac, user_pk, scenario_pk):
+        self._keyed_hmac = keyed_hmac
+        self._task_prefix = 'templatetask:{}:{}:'.format(user_pk, scenario_pk)
+        self._choice_prefix = 'choice:{}:{}:'.format(user_pk, scenario_pk)
+        self._task_macs = {}
+        self._choice_macs = {}
+        self._task_identifiers = {}
+
+    def get_task_mac(self, identifier):
+        try:
+            return self._task_macs[identifier]
+        except KeyError:
+            mac = self._compute_mac(self._task_prefix + identifier)
+            self._task_macs[identifier] = mac
+            self._task_identifiers[mac] = identifier
+            return mac
+
+    def get_choice_mac(self, task_identifier, name):
+        key = (task_identifier, name)
+        try:
+            return self._choice_macs[key]
+        except KeyError:
+            mac = self._compute_mac('{}{}:{}'.format(self._choice_prefix, task_identifier, name))
+            self._choice_macs[key] = mac
+            return mac
+
+    def find_task(self, template_tasks, task_mac):
+        """Returns the task with the given MAC or None.
+
+        :param template_tasks: Mapping of identifiers to TemplateTask objects
+        :param task_mac: The MAC of the task as hex string
+        :return: TemplateTask object or None
+        """
+        identifier = self._task_identifiers.get(task_mac)
+        if identifier is None:
+            for identifier in template_tasks:
+                self.get_task_mac(identifier)
+            identifier = self._task_identifiers.get(task_mac)
+        return template_tasks.get(identifier)
+
+    def _compute_mac(self, msg):
+        mac = self._keyed_hmac.copy()
+        mac.update(msg.encode())
+        return mac.hexdigest()
+
+
+def get_mac_table(user, scenario):
+    secret_key = settings.SECRET_KEY
+    keyed_hmac = _keyed_hmacs.get(secret_key)
+    if keyed_hmac is None:
+        keyed_hmac = hmac.new(secret_key.encode(), digestmod=hashlib.sha256)
+        _keyed_hmacs.set(secret_key, keyed_hmac)
+    return _mac_tables.get_or_create((secret_key, user.pk, scenario.pk),
+                                     lambda: MacTable(keyed_hmac, user.pk, scenario.pk))
+
+
+_keyed_hmacs = LRUCache(4)
+_mac_tables = LRUCache(settings.SCENARIO_MAC_CACHE_SIZE)
+
+
 task_classes = {
     MultipleChoiceTask.task_type: MultipleChoiceTask,
     SingleChoiceTask.task_type: SingleChoiceTask,
@@ -1,29 +1,182 @@
+import logging
 import os
+import threading
+import time
+from collections import namedtuple
 
+from django.conf import settings
 from jinja2 import TemplateNotFound
 from jinja2.loaders import BaseLoader
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+__all__ = ['ScenarioTemplateLoader', 'StatCache', 'stat_cache']
+
+
+logger = logging.getLogger(__name__)
+
+StatEntry = namedtuple('StatEntry', ['mtime', 'checked_at', 'watched'])
+
+
+class StatCache:
+    """Caches the modification times of scenario files.
+
+    Without watching, a file is stat'ed at most once per check_interval
+    seconds, so changes show up with a delay of at most check_interval.
+
+    With watch=True, the directories of the files are watched with inotify
+    and a file is only stat'ed again after an event for it was received.
+    If inotify is not available or the watcher fails, it falls back to the
+    check interval.
+    """
+    watch_flags = 0
+    if inotify_simple is not None:
+        watch_flags = (inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO |
+                       inotify_simple.flags.MOVED_FROM | inotify_simple.flags.CREATE |
+                       inotify_simple.flags.DELETE | inotify_simple.flags.ATTRIB |
+                       inotify_simple.flags.DELETE_SELF | inotify_simple.flags.MOVE_SELF)
+
+    def __init__(self, check_interval=2.0, watch=False):
+        self.check_interval = check_interval
+        self.watch = watch
+        self._entries = {}
+        # Incremented on every invalidation, see get_mtime
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._inotify = None
+        self._watched_dirs = {}
+        self._watch_descriptors = {}
+
+        if watch and inotify_simple is None:
+            logger.warning('inotify_simple is not installed, falling back to '
+                           'checking scenario files every %s seconds', check_interval)
+            self.watch = False
+
+    def get_mtime(self, filename):
+        """Returns the modification time of a file or None if it does not exist.
+
+        :param filename: Absolute path to the file
+        :return: float or None
+        """
+        entry = self._entries.get(filename)
+        now = time.monotonic()
+        if entry and (entry.watched or now - entry.checked_at < self.check_interval):
+            return entry.mtime
+
+        # Register the watch before the stat, so that no change is missed
+        watched = self.watch and self._watch_dir(os.path.dirname(filename))
+        generation = self._generation
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            # An invalidation during the stat might be for a change which
+            # happened after it, so the mtime must not be cached.
+            if self._generation == generation:
+                self._entries[filename] = StatEntry(mtime, now, watched)
+        return mtime
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(filename, None)
+
+    def _invalidate_all(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _invalidate_dir(self, dirname):
+        prefix = os.path.join(dirname, '')
+        with self._lock:
+            self._generation += 1
+            for filename in [f for f in self._entries if f.startswith(prefix)]:
+                del self._entries[filename]
+
+    def _watch_dir(self, dirname):
+        with self._lock:
+            if dirname in self._watch_descriptors:
+                return True
+            try:
+                if self._inotify is None:
+                    self._inotify = inotify_simple.INotify()
+                    watcher = threading.Thread(target=self._watch_events,
+                                               name='scenario-file-watcher',
+                                               daemon=True)
+                    watcher.start()
+                wd = self._inotify.add_watch(dirname, self.watch_flags)
+            except OSError as e:
+                logger.warning('Could not watch %s: %s', dirname, e)
+                return False
+            self._watched_dirs[wd] = dirname
+            self._watch_descriptors[dirname] = wd
+            return True
+
+    def _watch_events(self):
+        try:
+            self._read_events()
+        except Exception:
+            logger.exception('Scenario file watcher failed, falling back to checking '
+                             'scenario files every %s seconds', self.check_interval)
+            with self._lock:
+                self.watch = False
+                self._watched_dirs.clear()
+                self._watch_descriptors.clear()
+            self._invalidate_all()
+
+    def _read_events(self):
+        while True:
+            for event in self._inotify.read():
+                if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                    # Events were dropped, so every file has to be checked again
+                    self._invalidate_all()
+                    continue
+                dirname = self._watched_dirs.get(event.wd)
+                if dirname is None:
+                    continue
+                if event.mask & inotify_simple.flags.IGNORED:
+                    # Directory was removed or moved, the watch is gone
+                    with self._lock:
+                        del self._watched_dirs[event.wd]
+                        del self._watch_descriptors[dirname]
+                    self._invalidate_dir(dirname)
+                elif event.name:
+                    self.invalidate(os.path.join(dirname, event.name))
+                else:
+                    self._invalidate_dir(dirname)
+
 
 class ScenarioTemplateLoader(BaseLoader):
-    def __init__(self, scenario_dir):
-        self.scenario_dir = scenario_dir
+    def __init__(self, scenario_dir=None):
+        self._scenario_dir = scenario_dir
+
+    @property
+    def scenario_dir(self):
+        if self._scenario_dir is None:
+            return settings.SCENARIO_DIR
+        return self._scenario_dir
 
     def get_source(self, environment, template):
         filename = os.path.join(self.scenario_dir, template, 'scenario.html')
+        mtime = stat_cache.get_mtime(filename)
         try:
             with open(filename) as f:
                 contents = f.read()
-            mtime = os.path.getmtime(filename)
         except (IOError, OSError):
             raise TemplateNotFound(template)
 
         def uptodate():
-            try:
-                os.path.getmtime(filename) == mtime
-            except OSError:
-                return False
+            return mtime is not None and stat_cache.get_mtime(filename) == mtime
 
-        return contents, template, uptodate
+        return contents, filename, uptodate
 
     def list_templates(self):
         return os.listdir(self.scenario_dir)
+
+
+stat_cache = StatCache(settings.SCENARIO_FILE_CHECK_INTERVAL, settings.SCENARIO_FILE_WATCH)
@@ -0,0 +1,86 @@
+import numpy as np
+
+from insekta.scenarios.models import TaskConfiguration, TaskSolveArchive
+
+
+__all__ = ['get_points_table']
+
+
+def get_points_table(course_run, task_groups, participants):
+    """Compute the points of the participants of a course run.
+
+    The archived solves are loaded into a participants x tasks matrix,
+    the points of the task groups and the total points are computed as
+    matrix products.
+
+    :param course_run: CourseRun object
+    :param task_groups: List of TaskGroup objects with prefetched tasks
+    :param participants: List of users
+    :return: List of dicts with the keys name, task_groups and
+             total_points, in the same order as participants. task_groups
+             is a list of dicts with the keys points and solved_tasks.
+    """
+    task_points = {}
+    for task_group_id, task_id, points in (TaskConfiguration.objects
+                                           .filter(task_group__in=task_groups)
+                                           .values_list('task_group_id', 'task_id', 'points')):
+        task_points[(task_group_id, task_id)] = points
+
+    # Each column is a task in a task group. A task can be part of several
+    # task groups and therefore have several columns.
+    column_task_ids = []
+    column_points = []
+    column_groups = []
+    for group_index, task_group in enumerate(task_groups):
+        for task in task_group.tasks.all():
+            column_task_ids.append(task.pk)
+            column_points.append(task_points.get((task_group.pk, task.pk), 0))
+            column_groups.append(group_index)
+    column_points = np.array(column_points, dtype=float)
+
+    task_indices = {task_id: i for i, task_id in enumerate(dict.fromkeys(column_task_ids))}
+    participant_indices = {participant.pk: i for i, participant in enumerate(participants)}
+    solved = np.zeros((len(participants), len(task_indices)), dtype=bool)
+    archived_solves = (TaskSolveArchive.objects.filter(course_run=course_run)
+                       .values_list('user_id', 'task_id'))
+    for user_id, task_id in archived_solves:
+        if user_id in participant_indices and task_id in task_indices:
+            solved[participant_indices[user_id], task_indices[task_id]] = True
+    solved_columns = solved[:, [task_indices[task_id] for task_id in column_task_ids]]
+
+    # group_membership[c, g] is 1 if column c belongs to task group g
+    group_membership = np.zeros((len(column_task_ids), len(task_groups)))
+    group_membership[np.arange(len(column_task_ids)), column_groups] = 1
+    column_group_points = column_points[:, np.newaxis] * group_membership
+
+    group_points = solved_columns @ column_group_points
+    max_group_points = column_points @ group_membership
+    group_total_points = np.array([task_group.total_points for task_group in task_groups],
+                                  dtype=float)
+    scaled_group_points = _safe_divide(group_points, max_group_points) * group_total_points
+    total_points = (_safe_divide(group_points.sum(axis=1), column_points.sum()) *
+                    group_total_points.sum())
+
+    group_slices = []
+    start = 0
+    for group_index in range(len(task_groups)):
+        end = start + column_groups.count(group_index)
+        group_slices.append(slice(start, end))
+        start = end
+
+    points_table = []
+    for i, participant in enumerate(participants):
+        solved_tasks = solved_columns[i].tolist()
+        points_table.append({
+            'name': participant.get_full_name() or participant.username,
+            'task_groups': [{
+                'points': scaled_group_points[i, group_index],
+                'solved_tasks': solved_tasks[group_slice]
+            } for group_index, group_slice in enumerate(group_slices)],
+            'total_points': total_points[i],
+        })
+    return points_table
+
+
+def _safe_divide(a, b):
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b != 0)
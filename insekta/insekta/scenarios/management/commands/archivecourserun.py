@@ -0,0 +1,20 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from insekta.scenarios.models import CourseRun, TaskSolveArchive
+
+
+class Command(BaseCommand):
+    help = 'Archive the solves of all participants for the open task groups of a course run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_run_id', type=int)
+
+    def handle(self, *args, **options):
+        try:
+            course_run = CourseRun.objects.get(pk=options['course_run_id'])
+        except CourseRun.DoesNotExist:
+            raise CommandError('No such course run: {}'.format(options['course_run_id']))
+        num_archived = TaskSolveArchive.archive_course_run(course_run)
+        sys.stdout.write('Archived solves: {}\n'.format(num_archived))
@@ -18,3 +18,7 @@ class Command(BaseCommand):
             raise CommandError(str(e))
         sys.stdout.write("Sucessfully loaded '{}': {}\n".format(
             options['key'], scenario.title))
+        for name, summary in [('Tasks', scenario.task_updates),
+                              ('Comment ids', scenario.comment_id_updates)]:
+            sys.stdout.write('{}: {} created, {} updated, {} deleted\n'.format(
+                name, summary.created, summary.updated, summary.deleted))
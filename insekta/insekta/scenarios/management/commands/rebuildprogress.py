@@ -0,0 +1,22 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from insekta.scenarios.models import Scenario, ScenarioProgress
+
+
+class Command(BaseCommand):
+    help = 'Recompute the number of solved tasks per user and scenario'
+
+    def add_arguments(self, parser):
+        parser.add_argument('key', nargs='?', help='Only rebuild the progress of this scenario')
+
+    def handle(self, *args, **options):
+        scenario = None
+        if options['key']:
+            try:
+                scenario = Scenario.objects.get(key=options['key'])
+            except Scenario.DoesNotExist:
+                raise CommandError('No such scenario: {}'.format(options['key']))
+        num_entries = ScenarioProgress.rebuild(scenario=scenario)
+        sys.stdout.write('Rebuilt progress: {} entries\n'.format(num_entries))
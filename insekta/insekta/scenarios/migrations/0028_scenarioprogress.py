@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:29
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_progress(apps, schema_editor):
+    TaskSolve = apps.get_model('scenarios', 'TaskSolve')
+    ScenarioProgress = apps.get_model('scenarios', 'ScenarioProgress')
+    solve_counts = (TaskSolve.objects.order_by().values('user', 'task__scenario')
+                    .annotate(num_solved=Count('pk')))
+    ScenarioProgress.objects.bulk_create(
+        (ScenarioProgress(user_id=count['user'], scenario_id=count['task__scenario'],
+                          num_solved=count['num_solved']) for count in solve_counts.iterator()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenarios', '0027_alter_comment_id_alter_commentid_id_alter_course_id_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScenarioProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_solved', models.IntegerField(default=0)),
+                ('scenario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='progress', to='scenarios.scenario')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'scenario')},
+            },
+        ),
+        migrations.RunPython(populate_progress, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenarios', '0028_scenarioprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenarioprogress',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,25 +1,28 @@
+import copy
 import json
 import os
 import re
 import shutil
-import sys
 from collections import namedtuple
 
-from django.db import models, IntegrityError
+from django.db import models, connection, transaction, IntegrityError
 from django.conf import settings
-from django.db.models import Count
-from django.db.models.signals import pre_save
+from django.core.cache import cache
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django.urls import reverse
 
-from insekta.scenarios.dsl.taskparser import TaskParser
+from insekta.scenarios.dsl.scriptloader import load_script_classes
+from insekta.scenarios.dsl.scriptpool import ScriptNotFound, call_script
+from insekta.scenarios.dsl.taskparser import get_template_tasks
 from insekta.scenarios.dsl.tasks import ScriptTask
 
 
-_scenario_script_cache = {}
+CourseGroups = namedtuple('CourseGroups', ['topics', 'challenges'])
 
-ScriptCacheEntry = namedtuple('ScriptCacheEntry', ['mtime', 'script_classes'])
+UpdateSummary = namedtuple('UpdateSummary', ['created', 'updated', 'deleted'])
 
 
 class ScenarioError(Exception):
@@ -33,6 +36,8 @@ class Scenario(models.Model):
     num_tasks = models.IntegerField(default=0)
     enabled = models.BooleanField(default=False)
 
+    task_ids_cache_timeout = 300
+
     def __str__(self):
         return self.title
 
@@ -65,45 +70,19 @@ class Scenario(models.Model):
         return os.path.join(self.get_scenario_dir(), 'scripts.py')
 
     def get_template_tasks(self):
-        return TaskParser.from_filename(self.get_template_filename(), self).get_tasks()
+        return get_template_tasks(self.get_template_filename(), self)
 
     def get_script_classes(self):
-        scripts_filename = self.get_scripts_filename()
-        try:
-            mtime = os.stat(scripts_filename).st_mtime
-            script_cache = _scenario_script_cache.get(self.pk)
-            if script_cache:
-                if script_cache.mtime == mtime:
-                    return script_cache.script_classes
-            with open(scripts_filename) as f:
-                mod = {'sys': sys}
-                old_path = sys.path[:]
-                sys.path.append(os.path.abspath(os.path.dirname(scripts_filename)))
-                try:
-                    exec(f.read(), mod, mod)
-                finally:
-                    sys.path = old_path
-                if 'script_classes' not in mod:
-                    raise ValueError('{} is missing script_classes'.format(
-                        scripts_filename
-                    ))
-                cache_entry = ScriptCacheEntry(mtime, mod['script_classes'])
-                _scenario_script_cache[self.pk] = cache_entry
-                return mod['script_classes']
-        except IOError:
-            return {}
+        return load_script_classes(self.get_scripts_filename())
 
     def get_download(self, download_key):
         decrypted_key = ScriptTask.decrypt_download_key(download_key)
         script_name, user, task_identifier, filename = decrypted_key
         try:
-            script_class = self.get_script_classes()[script_name]
-        except KeyError:
+            content = call_script(self, script_name, user.pk, task_identifier,
+                                  'download', filename)
+        except ScriptNotFound:
             raise ValueError('Invalid script class: {}'.format(script_name))
-        instance = script_class(user.pk, task_identifier)
-        if not hasattr(instance, 'download'):
-            return b''
-        content = instance.download(filename)
         if content is None:
             content = b''
         elif isinstance(content, str):
@@ -111,60 +90,119 @@ class Scenario(models.Model):
         return content
 
     def update_tasks(self, purge=False):
-        existing_tasks = {}
-        for task in Task.objects.filter(scenario=self):
-            existing_tasks[task.identifier] = task
-        unused_task_identifiers = set(existing_tasks.keys())
+        """Synchronize the tasks with the tasks of the template.
+
+        :param purge: Delete tasks which are no longer in the template
+        :return: UpdateSummary with the number of created, updated and deleted tasks
+        """
         template_tasks = self.get_template_tasks()
-        for tpl_task in template_tasks.values():
-            unused_task_identifiers.discard(tpl_task.identifier)
-            task = existing_tasks.get(tpl_task.identifier)
-            if task:
-                task.order_id = tpl_task.order_id
-                task.save()
-            else:
-                Task.objects.create(scenario=self,
-                                    identifier=tpl_task.identifier,
-                                    order_id=tpl_task.order_id)
+        with transaction.atomic():
+            existing_tasks = {task.identifier: task for task in Task.objects.filter(scenario=self)}
+            new_tasks = []
+            changed_tasks = []
+            for tpl_task in template_tasks.values():
+                task = existing_tasks.pop(tpl_task.identifier, None)
+                if task is None:
+                    new_tasks.append(Task(scenario=self, identifier=tpl_task.identifier,
+                                          order_id=tpl_task.order_id))
+                elif task.order_id != tpl_task.order_id:
+                    task.order_id = tpl_task.order_id
+                    changed_tasks.append(task)
+            Task.objects.bulk_create(new_tasks, batch_size=500)
+            Task.objects.bulk_update(changed_tasks, ['order_id'], batch_size=500)
+
+            num_deleted = 0
+            if purge and existing_tasks:
+                Task.objects.filter(pk__in=[task.pk for task in existing_tasks.values()]).delete()
+                num_deleted = len(existing_tasks)
+                ScenarioProgress.rebuild(scenario=self)
         self.num_tasks = len(template_tasks)
-
-        if purge:
-            for unused_task_identifier in unused_task_identifiers:
-                existing_tasks[unused_task_identifier].delete()
+        cache.delete('scenarios:task_ids:{}'.format(self.pk))
+        return UpdateSummary(len(new_tasks), len(changed_tasks), num_deleted)
 
     def update_comment_ids(self, purge=False):
+        """Synchronize the comment ids with the data-comment-id attributes of the template.
+
+        Comment ids which are no longer used are deleted if they have no
+        comments, otherwise they are marked as orphaned.
+
+        :param purge: Also delete unused comment ids with comments
+        :return: UpdateSummary with the number of created, updated and deleted comment ids
+        """
         with open(self.get_template_filename()) as f:
             contents = f.read()
         comment_ids = set(re.findall(r'data-comment-id="([a-z0-9_-]{0,64})"', contents))
 
-        orphaned = CommentId.objects.filter(scenario=self).exclude(comment_id__in=comment_ids)
-        for orphaned_cid in orphaned:
-            if orphaned_cid.get_num_usages() == 0:
-                orphaned_cid.delete()
-            else:
-                if purge:
-                    orphaned_cid.comments.all().delete()
-                    orphaned_cid.delete()
-                else:
-                    orphaned_cid.orphaned = True
-                    orphaned_cid.save()
-
-        for comment_id in comment_ids:
-            comment_id_obj, created = CommentId.objects.get_or_create(
-                    scenario=self, comment_id=comment_id)
-            if not created:
-                comment_id_obj.orphaned = False
-                comment_id_obj.save()
+        with transaction.atomic():
+            existing_cids = (CommentId.objects.filter(scenario=self)
+                             .annotate(num_comments=Count('comments')))
+            new_comment_ids = set(comment_ids)
+            changed_cids = []
+            deleted_cid_pks = []
+            for cid in existing_cids:
+                if cid.comment_id in comment_ids:
+                    new_comment_ids.discard(cid.comment_id)
+                    if cid.orphaned:
+                        cid.orphaned = False
+                        changed_cids.append(cid)
+                elif purge or cid.num_comments == 0:
+                    deleted_cid_pks.append(cid.pk)
+                elif not cid.orphaned:
+                    cid.orphaned = True
+                    changed_cids.append(cid)
+            if deleted_cid_pks:
+                CommentId.objects.filter(pk__in=deleted_cid_pks).delete()
+            CommentId.objects.bulk_update(changed_cids, ['orphaned'], batch_size=500)
+            CommentId.objects.bulk_create(
+                [CommentId(scenario=self, comment_id=comment_id) for comment_id in new_comment_ids],
+                batch_size=500)
+        return UpdateSummary(len(new_comment_ids), len(changed_cids), len(deleted_cid_pks))
 
     def solve(self, user, task_obj, answer):
-        task = Task.objects.get(scenario=self, identifier=task_obj.identifier)
+        """Mark a task as solved by the user.
+
+        Solving an already solved task does not change anything.
+
+        :return: True if the task was not solved by the user before
+        """
         if not task_obj.must_remember_answer:
             answer = None
 
-        try:
-            TaskSolve.objects.create(task=task, user=user, answer=answer)
-        except IntegrityError:
-            pass
+        # The cached task ids are refreshed if they do not contain the task
+        # or are stale, e.g. after loadscenario --purge in another process.
+        for refresh in (False, True):
+            task_id = self.get_task_ids(refresh=refresh).get(task_obj.identifier)
+            if task_id is None:
+                continue
+            try:
+                with transaction.atomic():
+                    task_solve = TaskSolve.insert(task_id, user, answer)
+                    if task_solve is None:
+                        return False
+                    ScenarioProgress.add_solve(user, self)
+                    TaskSolveArchive.archive_solve(task_solve)
+                return True
+            except Task.DoesNotExist:
+                continue
+        raise Task.DoesNotExist('Task {} does not exist'.format(task_obj.identifier))
+
+    def get_task_ids(self, refresh=False):
+        """Return a dict mapping task identifiers to task ids.
+
+        The mapping is cached and invalidated by update_tasks.
+        """
+        key = 'scenarios:task_ids:{}'.format(self.pk)
+        task_ids = None if refresh else cache.get(key)
+        if task_ids is None:
+            task_ids = dict(Task.objects.filter(scenario=self).values_list('identifier', 'pk'))
+            cache.set(key, task_ids, self.task_ids_cache_timeout)
+        return task_ids
+
+    def reset_tasks(self, user):
+        with transaction.atomic():
+            TaskSolve.objects.filter(user=user, task__scenario=self).delete()
+            ScenarioProgress.objects.filter(user=user, scenario=self).update(
+                num_solved=0, version=models.F('version') + 1)
 
     def get_absolute_url(self, course):
         return reverse('scenarios:view', args=(course.key, self.key, ))
@@ -178,7 +216,9 @@ class Scenario(models.Model):
         return comment_counts
 
     def has_solved_all(self, user):
-        return self.tasks.count() == user.solved_tasks.filter(scenario=self).count()
+        # The progress also counts solves of tasks which were removed from
+        # the template but not purged, so it is compared with all tasks.
+        return ScenarioProgress.get_num_solved(user, self) >= len(self.get_task_ids())
 
     def is_supported_by(self, user):
         return bool(self.supportedscenario_set.filter(user=user).count())
@@ -242,13 +282,14 @@ class Scenario(models.Model):
             shutil.rmtree(scenario_media, ignore_errors=True)
             shutil.copytree(scenario_static, scenario_media)
 
-        scenario, _created = cls.objects.get_or_create(key=key)
-        scenario.title = title
-        scenario.is_challenge = is_challenge
-        scenario.requires_vpn = requires_vpn
-        scenario.update_tasks()
-        scenario.update_comment_ids()
-        scenario.save()
+        with transaction.atomic():
+            scenario, _created = cls.objects.get_or_create(key=key)
+            scenario.title = title
+            scenario.is_challenge = is_challenge
+            scenario.requires_vpn = requires_vpn
+            scenario.task_updates = scenario.update_tasks()
+            scenario.comment_id_updates = scenario.update_comment_ids()
+            scenario.save()
         return scenario
 
 
@@ -273,6 +314,127 @@ class TaskSolve(models.Model):
     class Meta:
         unique_together = (('task', 'user'),)
 
+    @classmethod
+    def insert(cls, task_id, user, answer=None):
+        """Insert a solve unless the user already solved the task.
+
+        On PostgreSQL this is a single INSERT ... SELECT ... ON CONFLICT DO
+        NOTHING, otherwise the insert runs in a savepoint.
+
+        :return: The new TaskSolve object or None if the task was already solved
+        :raises Task.DoesNotExist: If there is no task with the given id
+        """
+        task_solve = cls(task_id=task_id, user=user, answer=answer)
+        if connection.vendor == 'postgresql':
+            # Selecting the task checks that it exists, the foreign key
+            # constraint would only be checked when the transaction commits.
+            sql_query = '''
+            INSERT INTO {table} (task_id, user_id, answer, is_correct)
+            SELECT id, %s, %s, %s FROM {task_table} WHERE id = %s
+            ON CONFLICT (task_id, user_id) DO NOTHING RETURNING id
+            '''.format(table=cls._meta.db_table, task_table=Task._meta.db_table)
+            answer_value = cls._meta.get_field('answer').get_db_prep_save(answer, connection)
+            with connection.cursor() as c:
+                c.execute(sql_query, (user.pk, answer_value, task_solve.is_correct, task_id))
+                row = c.fetchone()
+            if row is None:
+                if not Task.objects.filter(pk=task_id).exists():
+                    raise Task.DoesNotExist('Task {} does not exist'.format(task_id))
+                return None
+            task_solve.pk = row[0]
+            task_solve._state.adding = False
+            task_solve._state.db = connection.alias
+            return task_solve
+
+        if not Task.objects.filter(pk=task_id).exists():
+            raise Task.DoesNotExist('Task {} does not exist'.format(task_id))
+        try:
+            with transaction.atomic():
+                task_solve.save(force_insert=True)
+        except IntegrityError:
+            if not cls.objects.filter(task_id=task_id, user=user).exists():
+                raise
+            return None
+        return task_solve
+
+
+class ScenarioProgress(models.Model):
+    """Number of solved tasks of a user in a scenario.
+
+    This is kept in sync with TaskSolve by Scenario.solve and
+    Scenario.reset_tasks. Use the rebuildprogress management command to
+    repair it after modifying TaskSolve objects in another way.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    scenario = models.ForeignKey(Scenario, related_name='progress', on_delete=models.CASCADE)
+    num_solved = models.IntegerField(default=0)
+    version = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('user', 'scenario'),)
+
+    def __str__(self):
+        return '{} solved {} tasks of {}'.format(self.user, self.num_solved, self.scenario)
+
+    @classmethod
+    def add_solve(cls, user, scenario):
+        table = cls._meta.db_table
+        sql_query = '''
+        INSERT INTO {table} (user_id, scenario_id, num_solved, version) VALUES (%s, %s, 1, 1)
+        ON CONFLICT (user_id, scenario_id) DO UPDATE
+        SET num_solved = {table}.num_solved + 1, version = {table}.version + 1
+        '''.format(table=table)
+        with connection.cursor() as c:
+            c.execute(sql_query, (user.pk, scenario.pk))
+
+    @classmethod
+    def get_num_solved(cls, user, scenario):
+        return cls.get_state(user, scenario)[0]
+
+    @classmethod
+    def get_state(cls, user, scenario):
+        """Return the progress of a user in a scenario.
+
+        :return: Tuple (num_solved, version). The version changes whenever
+                 tasks are solved or reset.
+        """
+        state = (cls.objects.filter(user=user, scenario=scenario)
+                 .values_list('num_solved', 'version').first())
+        return state or (0, 0)
+
+    @classmethod
+    def rebuild(cls, scenario=None):
+        """Recompute the progress from the solved tasks.
+
+        Existing entries are updated in place and their version is
+        incremented, so a (num_solved, version) state is never repeated.
+        Entries without solved tasks are kept with num_solved 0.
+
+        :param scenario: Only rebuild the progress of this scenario
+        :return: Number of progress entries written
+        """
+        progress = cls.objects.all()
+        task_solves = TaskSolve.objects.all()
+        if scenario:
+            progress = progress.filter(scenario=scenario)
+            task_solves = task_solves.filter(task__scenario=scenario)
+        num_solved = (TaskSolve.objects
+                      .filter(user=OuterRef('user'), task__scenario=OuterRef('scenario'))
+                      .order_by().values('user').annotate(count=Count('pk')).values('count'))
+        solve_counts = (task_solves.order_by().values('user', 'task__scenario')
+                        .annotate(num_solved=Count('pk')))
+        with transaction.atomic():
+            num_updated = progress.update(num_solved=Coalesce(Subquery(num_solved), 0),
+                                          version=models.F('version') + 1)
+            existing = set(progress.values_list('user_id', 'scenario_id'))
+            created = cls.objects.bulk_create(
+                (cls(user_id=count['user'], scenario_id=count['task__scenario'],
+                     num_solved=count['num_solved'], version=1)
+                 for count in solve_counts.iterator()
+                 if (count['user'], count['task__scenario']) not in existing),
+                batch_size=1000)
+        return num_updated + len(created)
+
 
 class Course(models.Model):
     title = models.CharField(max_length=120)
@@ -311,6 +473,63 @@ class TaskSolveArchive(models.Model):
     class Meta:
         unique_together = (('task', 'user', 'course_run'),)
 
+    @classmethod
+    def archive_solve(cls, task_solve):
+        """Archive a solve for all open task groups of the user's course runs.
+
+        :param task_solve: TaskSolve object
+        :return: Number of archived solves
+        """
+        # Looked up on every solve, a cached mapping would not see changes
+        # of other processes to task groups and configurations.
+        course_run_ids = (TaskConfiguration.objects
+                          .filter(task_id=task_solve.task_id,
+                                  task_group__deadline_at__gte=now(),
+                                  task_group__course_run__enabled=True,
+                                  task_group__course_run__participants=task_solve.user_id)
+                          .values_list('task_group__course_run_id', flat=True)
+                          .distinct())
+        archived_solves = [cls(course_run_id=course_run_id, task_id=task_solve.task_id,
+                               user_id=task_solve.user_id, answer=task_solve.answer,
+                               is_correct=task_solve.is_correct)
+                           for course_run_id in course_run_ids]
+        if archived_solves:
+            cls.objects.bulk_create(archived_solves, update_conflicts=True,
+                                    unique_fields=['task', 'user', 'course_run'],
+                                    update_fields=['answer', 'is_correct'])
+        return len(archived_solves)
+
+    @classmethod
+    def archive_course_run(cls, course_run):
+        """Archive all solves of the participants for the open task groups.
+
+        Solves for task groups whose deadline has passed are not archived,
+        so this can be run repeatedly until the last deadline.
+
+        :param course_run: CourseRun object
+        :return: Number of archived solves
+        """
+        sql_query = '''
+        INSERT INTO {archive} (course_run_id, task_id, user_id, answer, is_correct)
+        SELECT p.courserun_id, ts.task_id, ts.user_id, ts.answer, ts.is_correct
+        FROM {task_solve} ts
+        INNER JOIN {participants} p ON p.user_id = ts.user_id
+        WHERE p.courserun_id = %s AND EXISTS (
+            SELECT 1 FROM {task_config} tc
+            INNER JOIN {task_group} tg ON tg.id = tc.task_group_id
+            WHERE tc.task_id = ts.task_id AND tg.course_run_id = p.courserun_id
+                AND tg.deadline_at >= %s)
+        ON CONFLICT (task_id, user_id, course_run_id)
+        DO UPDATE SET answer = EXCLUDED.answer, is_correct = EXCLUDED.is_correct
+        '''.format(archive=cls._meta.db_table,
+                   task_solve=TaskSolve._meta.db_table,
+                   participants=CourseRun.participants.through._meta.db_table,
+                   task_config=TaskConfiguration._meta.db_table,
+                   task_group=TaskGroup._meta.db_table)
+        with connection.cursor() as c:
+            c.execute(sql_query, (course_run.pk, now()))
+            return c.rowcount
+
 
 class TaskGroup(models.Model):
     name = models.CharField(max_length=120)
@@ -345,51 +564,46 @@ class ScenarioGroup(models.Model):
                                               related_name='groups')
 
     @staticmethod
-    def annotate_list(scenario_group_list, is_challenge=None, user=None):
-        """Annotate a list of ScenarioGroup objects with scenarios attribute.
-
-        After calling this function, the ScenarioGroup objects in the list
-        will have an scenarios attribute, which is a sorted list of scenarios.
-        Additionally those scenarios will have an attribute num_tasks_solved,
-        which tells you, how many tasks were solved by the user.
-
-        :param scenario_group_list: List of ScenarioGroup objects
-        :param user: A django user
-        :return: list of ScenarioGroup objects
+    def load_course_groups(course, user=None):
+        """Load the visible scenario groups of a course with their scenarios.
+
+        The groups, their entries and the number of solved tasks are loaded
+        with a single query. The returned ScenarioGroup objects have a
+        scenarios attribute, which is a sorted list of enabled scenarios.
+        Those scenarios have an attribute num_tasks_solved, which tells you,
+        how many tasks were solved by the user. Groups without scenarios
+        are left out.
+
+        :param course: Course object
+        :param user: A django user or None
+        :return: CourseGroups with lists of ScenarioGroup objects for
+                 topics and challenges
         """
-        assert isinstance(scenario_group_list, list)
-
-        group_lookup = {group.pk: group for group in scenario_group_list}
-        for group in scenario_group_list:
-            group.scenarios = []
-
-        all_entries = (ScenarioGroupEntry.objects.select_related('scenario')
-                       .filter(scenario_group__in=scenario_group_list,
-                               scenario__enabled=True)
-                       .order_by('order_id'))
-        scenario_lookup = {}
-        for entry in all_entries:
-            scenario = entry.scenario
-            take_scenario = (is_challenge is None or
-                             scenario.is_challenge == is_challenge)
-            if not take_scenario:
-                continue
-            group = group_lookup[entry.scenario_group.pk]
-            group.scenarios.append(scenario)
-            scenario_lookup[scenario.pk] = scenario
-
-        for scenario in scenario_lookup.values():
-            scenario.num_tasks_solved = 0
+        entries = (ScenarioGroupEntry.objects
+                   .select_related('scenario', 'scenario_group')
+                   .filter(scenario_group__course=course,
+                           scenario_group__hidden=False,
+                           scenario__enabled=True)
+                   .order_by('scenario_group__order_id', 'scenario_group__pk', 'order_id'))
         if user:
-            task_counts = (Task.objects.filter(solved_by=user)
-                           .values('scenario').annotate(num_solved=Count('id')))
-            for task_count in task_counts:
-                scenario_pk = task_count['scenario']
-                if scenario_pk in scenario_lookup:
-                    scenario = scenario_lookup[scenario_pk]
-                    scenario.num_tasks_solved = task_count['num_solved']
+            num_solved = (ScenarioProgress.objects
+                          .filter(user=user, scenario=OuterRef('scenario'))
+                          .values('num_solved'))
+            entries = entries.annotate(num_tasks_solved=Coalesce(Subquery(num_solved), 0))
 
-        return [group for group in scenario_group_list if group.scenarios]
+        groups = {False: {}, True: {}}
+        for entry in entries:
+            scenario = entry.scenario
+            scenario.num_tasks_solved = getattr(entry, 'num_tasks_solved', 0)
+            challenge_groups = groups[scenario.is_challenge]
+            group = challenge_groups.get(entry.scenario_group_id)
+            if group is None:
+                group = copy.copy(entry.scenario_group)
+                group.scenarios = []
+                challenge_groups[group.pk] = group
+            group.scenarios.append(scenario)
+        return CourseGroups(topics=list(groups[False].values()),
+                            challenges=list(groups[True].values()))
 
     def __str__(self):
         return self.title
@@ -440,28 +654,3 @@ class Comment(models.Model):
     def __str__(self):
         return '{}: {} at {}'.format(self.comment_id, self.author, self.time_created)
 
-
-def _copy_task_solve(sender, instance, **kwargs):
-    user = instance.user
-    scenario_groups = instance.task.scenario.groups.all()
-    courses = Course.objects.filter(scenario_groups__in=scenario_groups)
-    course_runs = CourseRun.objects.filter(enabled=True,
-                                           course__in=courses,
-                                           participants=user)
-    for course_run in course_runs:
-
-        try:
-            task_group = TaskGroup.objects.get(
-                taskconfiguration__task=instance.task, course_run=course_run)
-        except TaskGroup.DoesNotExist:
-            continue
-        if task_group.deadline_at < now():
-            continue
-        archived_solve, created = TaskSolveArchive.objects.get_or_create(
-            course_run=course_run, user=user, task=instance.task)
-        archived_solve.answer = instance.answer
-        archived_solve.is_correct = instance.is_correct
-        archived_solve.save()
-
-
-pre_save.connect(_copy_task_solve, sender=TaskSolve)
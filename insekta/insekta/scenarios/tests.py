@@ -1,13 +1,39 @@
+import hashlib
+import hmac
 import os
+import re
+import sys
 import tempfile
+import unittest
+from datetime import timedelta
+from unittest import mock
 
 from django.test import TestCase
+from django.urls import reverse
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.utils import timezone
 from jinja2 import Environment
 
-from insekta.scenarios.dsl.taskparser import TaskParser
-from insekta.scenarios.dsl.renderer import Renderer
-from insekta.scenarios.models import Scenario
+from insekta.scenarios.dsl.fragments import FragmentTemplate
+from insekta.scenarios.dsl.highlighting import highlight_code
+from insekta.scenarios.dsl.scriptloader import load_script_classes
+from insekta.scenarios.dsl.scriptpool import ScriptNotFound, ScriptPool, ScriptTimeout
+from insekta.scenarios.dsl.scripts import ScriptInputValidationError
+from insekta.scenarios.dsl.taskparser import TaskParser, get_template_tasks
+from insekta.scenarios.dsl.tasks import MacTable, QuestionTask, ScriptTask, get_mac_table
+from insekta.scenarios.dsl.renderer import Renderer, get_scenario_template, render_scenario
+from insekta.scenarios.dsl.templateloader import StatCache, StatEntry, stat_cache
+from insekta.scenarios.grading import get_points_table
+from insekta.scenarios.models import (Comment, CommentId, Course, CourseRun, Scenario, ScenarioGroup, ScenarioGroupEntry,
+                                      ScenarioProgress, Task, TaskConfiguration, TaskGroup, TaskSolve,
+                                      TaskSolveArchive)
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 
 TEMPLATE = '''
@@ -33,7 +59,7 @@ class ParserTestCase(TestCase):
 
     def test_question(self):
         ast = self.env.parse(TEMPLATE)
-        p = TaskParser(ast)
+        p = TaskParser(ast, None)
         tasks = p.get_tasks()
         self.assertEqual(len(tasks), 2)
 
@@ -56,12 +82,78 @@ class ParserTestCase(TestCase):
         self.assertEqual(question.strip, False)
         self.assertEqual(question.case_sensitive, False)
 
+    def test_cached_tasks(self):
+        scenario = Scenario(pk=1, key='test')
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.html') as f:
+            f.write(TEMPLATE)
+            f.flush()
+            tasks = get_template_tasks(f.name, scenario)
+            self.assertEqual(set(tasks), {'hello', 'world'})
+            self.assertIs(get_template_tasks(f.name, scenario), tasks)
+            with self.assertRaises(TypeError):
+                tasks['foo'] = None
+
+
+class StatCacheTestCase(TestCase):
+    def test_check_interval(self):
+        with tempfile.NamedTemporaryFile() as f:
+            os.utime(f.name, (1, 1))
+            cache = StatCache(check_interval=3600)
+            self.assertEqual(cache.get_mtime(f.name), 1)
+            os.utime(f.name, (2, 2))
+            self.assertEqual(cache.get_mtime(f.name), 1)
+            cache.invalidate(f.name)
+            self.assertEqual(cache.get_mtime(f.name), 2)
+        self.assertEqual(cache.get_mtime(f.name), 2)
+        self.assertIsNone(StatCache(check_interval=0).get_mtime(f.name))
+
+    def test_invalidate_during_stat(self):
+        with tempfile.NamedTemporaryFile() as f:
+            os.utime(f.name, (1, 1))
+            cache = StatCache(check_interval=3600)
+            real_stat = os.stat
+
+            def stat(filename):
+                result = real_stat(filename)
+                cache.invalidate(filename)
+                return result
+
+            with mock.patch('insekta.scenarios.dsl.templateloader.os.stat', stat):
+                self.assertEqual(cache.get_mtime(f.name), 1)
+            os.utime(f.name, (2, 2))
+            self.assertEqual(cache.get_mtime(f.name), 2)
+
+    def test_watcher_failure(self):
+        cache = StatCache(check_interval=3600)
+        cache.watch = True
+        cache._entries['/scenario/scenario.html'] = StatEntry(1, 0, True)
+        cache._inotify = mock.Mock()
+        cache._inotify.read.side_effect = OSError('read failed')
+        with self.assertLogs('insekta.scenarios.dsl.templateloader', 'ERROR'):
+            cache._watch_events()
+        self.assertFalse(cache.watch)
+        self.assertEqual(cache._entries, {})
+
+    @unittest.skipIf(inotify_simple is None, 'inotify_simple is not installed')
+    def test_queue_overflow(self):
+        cache = StatCache(check_interval=3600)
+        cache.watch = True
+        cache._entries['/scenario/scenario.html'] = StatEntry(1, 0, True)
+        overflow = inotify_simple.Event(-1, inotify_simple.flags.Q_OVERFLOW, 0, '')
+        cache._inotify = mock.Mock()
+        # The watcher loop is left when read raises StopIteration
+        cache._inotify.read.side_effect = [[overflow]]
+        with self.assertRaises(StopIteration):
+            cache._read_events()
+        self.assertEqual(cache._entries, {})
+
 
 class RendererTestCase(TestCase):
     def setUp(self):
         User = get_user_model()
         self.user = User.objects.create(username='test')
         self.scenario = Scenario.objects.create(key='test', title='Test', num_tasks=2)
+        self.course = Course.objects.create(key='course', title='Course')
 
     def test_renderer(self):
         with tempfile.TemporaryDirectory() as scenario_dir:
@@ -71,17 +163,550 @@ class RendererTestCase(TestCase):
             with self.settings(SCENARIO_DIR=scenario_dir):
                 self._run_test_renderer()
 
+    def test_template_cache(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            filename = os.path.join(scenario_dir, 'test', 'scenario.html')
+            os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write('first')
+            os.utime(filename, (1, 1))
+            with self.settings(SCENARIO_DIR=scenario_dir):
+                template = get_scenario_template(self.scenario)
+                self.assertIs(get_scenario_template(self.scenario), template)
+                with open(filename, 'w') as f:
+                    f.write('second')
+                os.utime(filename, (2, 2))
+                stat_cache.invalidate(filename)
+                self.assertEqual(get_scenario_template(self.scenario).render(), 'second')
+
+    def test_output_cache(self):
+        Task.objects.create(scenario=self.scenario, identifier='hello')
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            os.makedirs(os.path.join(scenario_dir, 'test'))
+            with open(os.path.join(scenario_dir, 'test', 'scenario.html'), 'w') as f:
+                f.write(TEMPLATE)
+            with self.settings(SCENARIO_DIR=scenario_dir):
+                output = render_scenario(self.course, self.scenario, self.user, 'token1', {}, None)
+                self.assertIn('token1', output)
+                with self.assertNumQueries(1):
+                    cached_output = render_scenario(self.course, self.scenario, self.user,
+                                                    'token2', {}, None)
+                self.assertEqual(cached_output, output.replace('token1', 'token2'))
+
+                self.scenario.solve(self.user, QuestionTask('hello'), None)
+                self.assertNotEqual(render_scenario(self.course, self.scenario, self.user,
+                                                    'token1', {}, None), output)
+
+    def test_output_cache_included_files(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            os.makedirs(os.path.join(scenario_dir, 'test'))
+            with open(os.path.join(scenario_dir, 'test', 'scenario.html'), 'w') as f:
+                f.write('{{ code(filename="example.txt") }}')
+            example_filename = os.path.join(scenario_dir, 'test', 'example.txt')
+            with self.settings(SCENARIO_DIR=scenario_dir):
+                for i, content in enumerate(['first', 'second'], 1):
+                    with open(example_filename, 'w') as f:
+                        f.write(content)
+                    os.utime(example_filename, (i, i))
+                    stat_cache.invalidate(example_filename)
+                    output = render_scenario(self.course, self.scenario, self.user, 'token',
+                                             {}, None)
+                    self.assertIn(content, output)
+
     def _run_test_renderer(self):
-        renderer = Renderer(self.scenario, self.user, 'somecsrftoken')
+        renderer = Renderer(self.course, self.scenario, self.user, 'somecsrftoken', {}, None)
         hello = renderer.template_tasks['hello']
         cookies_key = hello.choices['cookies'].get_mac(
             self.user, self.scenario, hello.identifier)
         morecookies_key = hello.choices['morecookies'].get_mac(
             self.user, self.scenario, hello.identifier)
-        tpl_task = renderer.submit({
+        result = renderer.submit({
             'task': hello.get_mac(self.user, self.scenario),
             cookies_key: '1',
             morecookies_key: '1'
         })
-        self.assertEqual(tpl_task.identifier, hello.identifier)
+        self.assertTrue(result.is_correct)
+        self.assertEqual(result.task.identifier, hello.identifier)
         renderer.render()
+
+
+class MacTableTestCase(TestCase):
+    def setUp(self):
+        self.template_tasks = {'hello': mock.sentinel.hello, 'world': mock.sentinel.world}
+        self.user = mock.Mock(pk=1)
+        self.scenario = mock.Mock(pk=2)
+
+    def test_find_task(self):
+        mac_table = get_mac_table(self.user, self.scenario)
+        task_mac = mac_table.get_task_mac('hello')
+        self.assertIs(mac_table.find_task(self.template_tasks, task_mac), mock.sentinel.hello)
+
+        # A new table has to compute the MACs of all tasks to find one
+        keyed_hmac = hmac.new(b'key', digestmod=hashlib.sha256)
+        task_mac = MacTable(keyed_hmac, self.user.pk, self.scenario.pk).get_task_mac('world')
+        mac_table = MacTable(keyed_hmac, self.user.pk, self.scenario.pk)
+        self.assertIs(mac_table.find_task(self.template_tasks, task_mac), mock.sentinel.world)
+
+    def test_tampered_mac(self):
+        mac_table = get_mac_table(self.user, self.scenario)
+        task_mac = mac_table.get_task_mac('hello')
+        tampered_mac = ('0' if task_mac[0] != '0' else '1') + task_mac[1:]
+        self.assertIsNone(mac_table.find_task(self.template_tasks, tampered_mac))
+        other_mac = get_mac_table(mock.Mock(pk=3), self.scenario).get_task_mac('hello')
+        self.assertIsNone(mac_table.find_task(self.template_tasks, other_mac))
+
+    def test_unknown_task(self):
+        mac_table = get_mac_table(self.user, self.scenario)
+        task_mac = mac_table.get_task_mac('removed')
+        self.assertIsNone(mac_table.find_task(self.template_tasks, task_mac))
+        self.assertIsNone(mac_table.find_task(self.template_tasks, 'not a mac'))
+
+
+class CourseGroupsTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        self.course = Course.objects.create(key='course', title='Course')
+        first = ScenarioGroup.objects.create(title='First', course=self.course, order_id=1)
+        second = ScenarioGroup.objects.create(title='Second', course=self.course, order_id=2)
+        hidden = ScenarioGroup.objects.create(title='Hidden', course=self.course, hidden=True)
+        scenarios = {}
+        for key, is_challenge in [('a', False), ('b', False), ('c', True), ('d', False)]:
+            scenarios[key] = Scenario.objects.create(key=key, title=key, enabled=True,
+                                                     is_challenge=is_challenge, num_tasks=2)
+        for group, key, order_id in [(first, 'b', 2), (first, 'a', 1), (second, 'c', 1),
+                                     (hidden, 'd', 1)]:
+            ScenarioGroupEntry.objects.create(scenario_group=group, scenario=scenarios[key],
+                                              order_id=order_id)
+        for identifier in ['x', 'y']:
+            task = Task.objects.create(scenario=scenarios['a'], identifier=identifier)
+            TaskSolve.objects.create(task=task, user=self.user)
+        ScenarioProgress.rebuild()
+
+    def test_load_course_groups(self):
+        with self.assertNumQueries(1):
+            topics, challenges = ScenarioGroup.load_course_groups(self.course, self.user)
+        self.assertEqual([group.title for group in topics], ['First'])
+        self.assertEqual([scenario.key for scenario in topics[0].scenarios], ['a', 'b'])
+        self.assertEqual([scenario.num_tasks_solved for scenario in topics[0].scenarios], [2, 0])
+        self.assertEqual([group.title for group in challenges], ['Second'])
+        self.assertEqual(challenges[0].scenarios[0].num_tasks_solved, 0)
+
+
+class ScenarioProgressTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        self.scenario = Scenario.objects.create(key='test', title='Test', num_tasks=2)
+        self.task_objs = {}
+        for identifier in ['x', 'y']:
+            Task.objects.create(scenario=self.scenario, identifier=identifier)
+            self.task_objs[identifier] = QuestionTask(identifier)
+
+    def test_solve_and_reset(self):
+        self.assertTrue(self.scenario.solve(self.user, self.task_objs['x'], None))
+        self.assertFalse(self.scenario.solve(self.user, self.task_objs['x'], None))
+        self.assertEqual(ScenarioProgress.get_num_solved(self.user, self.scenario), 1)
+        self.assertFalse(self.scenario.has_solved_all(self.user))
+        self.scenario.solve(self.user, self.task_objs['y'], None)
+        self.assertTrue(self.scenario.has_solved_all(self.user))
+
+        ScenarioProgress.objects.all().delete()
+        self.assertEqual(ScenarioProgress.rebuild(), 1)
+        self.assertEqual(ScenarioProgress.get_num_solved(self.user, self.scenario), 2)
+
+        self.scenario.reset_tasks(self.user)
+        self.assertEqual(ScenarioProgress.get_num_solved(self.user, self.scenario), 0)
+        self.assertFalse(TaskSolve.objects.exists())
+
+    def test_solved_all_with_unpurged_tasks(self):
+        self.scenario.solve(self.user, self.task_objs['x'], None)
+        self.scenario.solve(self.user, self.task_objs['y'], None)
+        # The template now has the tasks a and b, x and y were not purged
+        for identifier in ['a', 'b']:
+            Task.objects.create(scenario=self.scenario, identifier=identifier)
+            self.task_objs[identifier] = QuestionTask(identifier)
+        cache.clear()
+        self.assertFalse(self.scenario.has_solved_all(self.user))
+        self.scenario.solve(self.user, self.task_objs['a'], None)
+        self.scenario.solve(self.user, self.task_objs['b'], None)
+        self.assertTrue(self.scenario.has_solved_all(self.user))
+
+    def test_rebuild_changes_state(self):
+        self.scenario.solve(self.user, self.task_objs['x'], None)
+        solved_state = ScenarioProgress.get_state(self.user, self.scenario)
+        self.scenario.reset_tasks(self.user)
+        self.assertEqual(ScenarioProgress.rebuild(), 1)
+        self.assertEqual(ScenarioProgress.get_state(self.user, self.scenario)[0], 0)
+        self.scenario.solve(self.user, self.task_objs['y'], None)
+        # The output cache relies on states not being repeated
+        self.assertNotEqual(ScenarioProgress.get_state(self.user, self.scenario), solved_state)
+
+    def test_duplicate_solve(self):
+        task_id = self.scenario.get_task_ids()['x']
+        self.assertIsNotNone(TaskSolve.insert(task_id, self.user))
+        self.assertIsNone(TaskSolve.insert(task_id, self.user))
+        self.assertEqual(TaskSolve.objects.filter(task_id=task_id).count(), 1)
+        self.assertFalse(self.scenario.solve(self.user, self.task_objs['x'], None))
+
+    def test_stale_task_ids(self):
+        old_task_id = self.scenario.get_task_ids()['x']
+        # Like loadscenario --purge in another process, the cache is not updated
+        Task.objects.filter(pk=old_task_id).delete()
+        new_task = Task.objects.create(scenario=self.scenario, identifier='x')
+        with self.assertRaises(Task.DoesNotExist):
+            TaskSolve.insert(old_task_id, self.user)
+        self.assertTrue(self.scenario.solve(self.user, self.task_objs['x'], None))
+        self.assertTrue(TaskSolve.objects.filter(task=new_task, user=self.user).exists())
+        self.assertEqual(self.scenario.get_task_ids()['x'], new_task.pk)
+
+        Task.objects.filter(identifier='y').delete()
+        with self.assertRaises(Task.DoesNotExist):
+            self.scenario.solve(self.user, self.task_objs['y'], None)
+
+
+class GradingTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        course = Course.objects.create(key='course', title='Course')
+        self.course_run = CourseRun.objects.create(course=course, name='Run')
+        self.course_run.participants.add(self.alice, self.bob)
+        scenario = Scenario.objects.create(key='test', title='Test', num_tasks=3)
+        self.tasks = [Task.objects.create(scenario=scenario, identifier=identifier, order_id=i)
+                      for i, identifier in enumerate(['x', 'y', 'z'])]
+        deadline = timezone.now() + timedelta(days=1)
+        self.first = TaskGroup.objects.create(name='First', deadline_at=deadline,
+                                              total_points=10, course_run=self.course_run)
+        self.second = TaskGroup.objects.create(name='Second', deadline_at=deadline,
+                                               total_points=20, course_run=self.course_run)
+        for task, points in zip(self.tasks[:2], [1, 3]):
+            TaskConfiguration.objects.create(task=task, task_group=self.first, points=points)
+        TaskConfiguration.objects.create(task=self.tasks[2], task_group=self.second, points=4)
+        for task in self.tasks[1:]:
+            TaskSolveArchive.objects.create(course_run=self.course_run, task=task, user=self.alice)
+
+    def test_points_table(self):
+        prefetch = Prefetch('tasks', Task.objects.order_by('order_id'))
+        task_groups = list(TaskGroup.objects.order_by('name').prefetch_related(prefetch))
+        with self.assertNumQueries(2):
+            points_table = get_points_table(self.course_run, task_groups,
+                                            [self.alice, self.bob])
+        alice, bob = points_table
+        self.assertEqual(alice['name'], 'alice')
+        self.assertEqual([group['solved_tasks'] for group in alice['task_groups']],
+                         [[False, True], [True]])
+        self.assertEqual([group['points'] for group in alice['task_groups']], [7.5, 20])
+        self.assertEqual(alice['total_points'], 7 / 8 * 30)
+        self.assertEqual([group['points'] for group in bob['task_groups']], [0, 0])
+        self.assertEqual(bob['total_points'], 0)
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        course = Course.objects.create(key='course', title='Course')
+        self.course_run = CourseRun.objects.create(course=course, name='Run', enabled=True)
+        self.course_run.participants.add(self.user)
+        self.scenario = Scenario.objects.create(key='test', title='Test', num_tasks=2)
+        self.task_objs = {}
+        open_group = TaskGroup.objects.create(name='Open', total_points=1,
+                                              deadline_at=timezone.now() + timedelta(days=1),
+                                              course_run=self.course_run)
+        closed_group = TaskGroup.objects.create(name='Closed', total_points=1,
+                                                deadline_at=timezone.now() - timedelta(days=1),
+                                                course_run=self.course_run)
+        for identifier, task_group in [('open', open_group), ('closed', closed_group)]:
+            task = Task.objects.create(scenario=self.scenario, identifier=identifier)
+            TaskConfiguration.objects.create(task=task, task_group=task_group)
+            self.task_objs[identifier] = QuestionTask(identifier)
+
+    def test_archive_solve(self):
+        self.scenario.solve(self.user, self.task_objs['open'], None)
+        self.scenario.solve(self.user, self.task_objs['closed'], None)
+        archived = TaskSolveArchive.objects.values_list('task__identifier', flat=True)
+        self.assertEqual(list(archived), ['open'])
+
+    def test_archive_after_deadline_change(self):
+        self.scenario.solve(self.user, self.task_objs['open'], None)
+        # Like extending the deadline in another process, no signals are sent
+        TaskGroup.objects.filter(name='Closed').update(
+            deadline_at=timezone.now() + timedelta(days=1))
+        self.scenario.solve(self.user, self.task_objs['closed'], None)
+        archived = TaskSolveArchive.objects.values_list('task__identifier', flat=True)
+        self.assertEqual(set(archived), {'open', 'closed'})
+
+    def test_archive_course_run(self):
+        for task in Task.objects.all():
+            TaskSolve.objects.create(task=task, user=self.user)
+        self.assertEqual(TaskSolveArchive.archive_course_run(self.course_run), 1)
+        self.assertEqual(TaskSolveArchive.archive_course_run(self.course_run), 1)
+        archived = TaskSolveArchive.objects.values_list('task__identifier', flat=True)
+        self.assertEqual(list(archived), ['open'])
+
+
+class UpdateTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        self.scenario = Scenario.objects.create(key='test', title='Test')
+
+    def test_update(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            filename = os.path.join(scenario_dir, 'test', 'scenario.html')
+            os.makedirs(os.path.dirname(filename))
+            with self.settings(SCENARIO_DIR=scenario_dir):
+                self._write_template(filename, TEMPLATE + '<p data-comment-id="a"></p>', 1)
+                self.assertEqual(self.scenario.update_tasks(), (2, 0, 0))
+                self.assertEqual(self.scenario.update_comment_ids(), (1, 0, 0))
+                Comment.objects.create(comment_id=CommentId.objects.get(), author=self.user,
+                                       text='Comment')
+
+                self._write_template(filename, '<p data-comment-id="b"></p>', 2)
+                self.assertEqual(self.scenario.update_tasks(purge=True), (0, 0, 2))
+                self.assertEqual(self.scenario.update_comment_ids(), (1, 1, 0))
+                self.assertTrue(CommentId.objects.get(comment_id='a').orphaned)
+                self.assertEqual(self.scenario.update_comment_ids(purge=True), (0, 0, 1))
+                self.assertFalse(Comment.objects.exists())
+
+    def _write_template(self, filename, contents, mtime):
+        with open(filename, 'w') as f:
+            f.write(contents)
+        os.utime(filename, (mtime, mtime))
+        stat_cache.invalidate(filename)
+
+
+SCRIPTS = '''
+import time
+
+from insekta.scenarios.dsl.scripts import BaseScript, ScriptInputValidationError
+
+
+class Sum(BaseScript):
+    def generate(self):
+        return {'a': self._seed, 'b': 2}
+
+    def validate(self, values, validation_context):
+        if values['sum'] == 'sleep':
+            time.sleep(10)
+        if int(values['sum']) != self._seed + 2:
+            raise ScriptInputValidationError('Wrong sum')
+        validation_context['checked'] = True
+        return True
+
+
+script_classes = {'sum': Sum}
+'''
+
+
+class ScriptPoolTestCase(TestCase):
+    def setUp(self):
+        self.scenario_dir = tempfile.TemporaryDirectory()
+        self.scripts_filename = os.path.join(self.scenario_dir.name, 'scripts.py')
+        with open(self.scripts_filename, 'w') as f:
+            f.write(SCRIPTS)
+        self.pool = ScriptPool(1, timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.scenario_dir.cleanup()
+
+    def test_pool(self):
+        self.assertEqual(self._call('generate'), {'a': 3, 'b': 2})
+        self.assertEqual(self._call('validate', {'sum': '5'}, {}), (True, {'checked': True}))
+        with self.assertRaises(ScriptInputValidationError) as cm:
+            self._call('validate', {'sum': '4'}, {})
+        self.assertEqual(cm.exception.message, 'Wrong sum')
+        with self.assertRaises(ScriptTimeout):
+            self._call('validate', {'sum': 'sleep'}, {})
+        with self.assertRaises(ScriptNotFound):
+            self._call('generate', script_name='missing')
+        self.assertEqual(self._call('download', 'file.txt'), None)
+
+    def _call(self, method, *args, script_name='sum'):
+        return self.pool.call((method, self.scripts_filename, script_name, 3, 'task',
+                               args, 'en'))
+
+
+class ScriptValuesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        self.scenario = Scenario.objects.create(key='test', title='Test')
+
+    def test_values_cache(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            filename = os.path.join(scenario_dir, 'test', 'scripts.py')
+            os.makedirs(os.path.dirname(filename))
+            with self.settings(SCENARIO_DIR=scenario_dir):
+                task = ScriptTask('sum', 'sum', self.scenario)
+                self._write_scripts(filename, SCRIPTS, 1)
+                self.assertEqual(task.get_values(self.user), {'a': self.user.pk, 'b': 2})
+                self._write_scripts(filename, SCRIPTS.replace("'b': 2", "'b': 3"), 1)
+                self.assertEqual(task.get_values(self.user)['b'], 2)
+                self._write_scripts(filename, SCRIPTS.replace("'b': 2", "'b': 3"), 2)
+                self.assertEqual(task.get_values(self.user)['b'], 3)
+
+    def _write_scripts(self, filename, contents, mtime):
+        with open(filename, 'w') as f:
+            f.write(contents)
+        os.utime(filename, (mtime, mtime))
+        stat_cache.invalidate(filename)
+
+
+class ScriptLoaderTestCase(TestCase):
+    def test_load_script_classes(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            filename = os.path.join(scenario_dir, 'scripts.py')
+            with open(os.path.join(scenario_dir, 'scripthelper.py'), 'w') as f:
+                f.write('VALUE = 42\n')
+            with open(filename, 'w') as f:
+                f.write('import scripthelper\nscript_classes = {"value": scripthelper.VALUE}\n')
+            old_path = sys.path[:]
+            script_classes = load_script_classes(filename)
+            self.assertEqual(script_classes, {'value': 42})
+            self.assertIs(load_script_classes(filename), script_classes)
+            self.assertEqual(sys.path, old_path)
+
+            with open(filename, 'w') as f:
+                f.write('script_classes = {"value": sys.maxsize}\n')
+            os.utime(filename, (1, 1))
+            stat_cache.invalidate(filename)
+            self.assertEqual(load_script_classes(filename), {'value': sys.maxsize})
+            sys.modules.pop('scripthelper', None)
+
+
+class HighlightTestCase(TestCase):
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with self.settings(SCENARIO_HIGHLIGHT_CACHE_DIR=cache_dir):
+                html = highlight_code('print("disk cache")', 'python', linestart=3)
+                self.assertIn('disk cache', html)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                self.assertEqual(highlight_code('print("disk cache")', 'python', linestart=3),
+                                 html)
+                self.assertNotEqual(highlight_code('print("disk cache")', 'python'), html)
+
+
+class FragmentTemplateTestCase(TestCase):
+    def setUp(self):
+        self.env = Environment()
+        self.context = {
+            'media': lambda path: '/media/' + path,
+            'vm_ip': lambda name: '10.0.0.1',
+        }
+
+    def test_split(self):
+        source = ('<p>{{ media("a.png") }}</p>{% for i in range(2) %}{{ i }}{% endfor %}'
+                  '<p>{{ vm_ip("web") }}</p>{% if vm_ip("web") %}yes{% endif %}<p>end</p>')
+        template = FragmentTemplate(self.env, self.env.parse(source), 'test', None)
+        self.assertEqual(template.num_static_parts, 3)
+        expected = self.env.from_string(source).render(self.context)
+        self.assertEqual(template.render(self.context), expected)
+        self.assertEqual(template.render(self.context), expected)
+
+    def test_included_files(self):
+        self.context['code'] = lambda filename=None: '<pre>{}</pre>'.format(filename)
+        source = ('{{ code(filename="a.py") }}<p>{{ media("a.png") }}</p>'
+                  '{% for name in ["b.py"] %}{{ code(filename=name) }}{% endfor %}')
+        template = FragmentTemplate(self.env, self.env.parse(source), 'test', None)
+        self.assertEqual(template.included_files, {'a.py'})
+        self.assertEqual(template.num_static_parts, 1)
+        self.assertEqual(template.render(self.context),
+                         '<pre>a.py</pre><p>/media/a.png</p><pre>b.py</pre>')
+
+    def test_global_nodes(self):
+        source = '{% set ip = vm_ip("web") %}<p>{{ ip }}</p>'
+        template = FragmentTemplate(self.env, self.env.parse(source), 'test', None)
+        self.assertEqual(template.num_static_parts, 0)
+        self.assertEqual(template.render(self.context), '<p>10.0.0.1</p>')
+
+
+class StreamingViewTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username='test')
+        self.course = Course.objects.create(key='course', title='Course', enabled=True)
+        self.scenario = Scenario.objects.create(key='test', title='Test', enabled=True)
+        group = ScenarioGroup.objects.create(title='Group', course=self.course)
+        ScenarioGroupEntry.objects.create(scenario_group=group, scenario=self.scenario)
+        self.client.force_login(self.user)
+
+    def test_streaming(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            os.makedirs(os.path.join(scenario_dir, 'test'))
+            with open(os.path.join(scenario_dir, 'test', 'scenario.html'), 'w') as f:
+                f.write('<p>Streamed scenario</p>')
+            with open(os.path.join(scenario_dir, 'test', 'meta.json'), 'w') as f:
+                f.write('{"title": "Test"}')
+            url = reverse('scenarios:view', args=(self.course.key, self.scenario.key))
+            with self.settings(SCENARIO_DIR=scenario_dir, SCENARIO_STREAMING=True):
+                response = self.client.get(url)
+                self.assertTrue(response.streaming)
+                streamed_page = b''.join(response.streaming_content).decode()
+            with self.settings(SCENARIO_DIR=scenario_dir, SCENARIO_STREAMING=False):
+                page = self.client.get(url).content.decode()
+        self.assertIn('<p>Streamed scenario</p>', streamed_page)
+        # Masked csrf tokens differ between responses
+        csrf_pattern = r'name="csrfmiddlewaretoken" value="[^"]*"'
+        self.assertEqual(re.sub(csrf_pattern, '', streamed_page), re.sub(csrf_pattern, '', page))
+
+    def test_streaming_error(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            os.makedirs(os.path.join(scenario_dir, 'test'))
+            with open(os.path.join(scenario_dir, 'test', 'scenario.html'), 'w') as f:
+                f.write('<p>Start</p>{{ vm_ip("web").missing() }}<p>End</p>')
+            with open(os.path.join(scenario_dir, 'test', 'meta.json'), 'w') as f:
+                f.write('{"title": "Test"}')
+            url = reverse('scenarios:view', args=(self.course.key, self.scenario.key))
+            with self.settings(SCENARIO_DIR=scenario_dir, SCENARIO_STREAMING=True), \
+                    self.assertLogs('insekta.scenarios.views', 'ERROR'):
+                response = self.client.get(url)
+                streamed_page = b''.join(response.streaming_content).decode()
+        self.assertIn('<p>Start</p>', streamed_page)
+        self.assertIn('An error occurred while showing this scenario.', streamed_page)
+        self.assertNotIn('<p>End</p>', streamed_page)
+        # The rest of the page is still sent
+        self.assertIn('</html>', streamed_page)
+
+
+SCRIPT_TEMPLATE = '''
+{% call task(identifier='sum', type='script', script_name='sum') %}
+{{ script_input(name='sum') }}
+{% endcall %}
+'''
+
+
+class ScriptErrorViewTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username='test', is_superuser=True)
+        self.course = Course.objects.create(key='course', title='Course', enabled=True)
+        self.scenario = Scenario.objects.create(key='test', title='Test', enabled=True)
+        group = ScenarioGroup.objects.create(title='Group', course=self.course)
+        ScenarioGroupEntry.objects.create(scenario_group=group, scenario=self.scenario)
+        Task.objects.create(scenario=self.scenario, identifier='sum')
+        self.client.force_login(self.user)
+
+    def test_script_timeout(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            os.makedirs(os.path.join(scenario_dir, 'test'))
+            with open(os.path.join(scenario_dir, 'test', 'scenario.html'), 'w') as f:
+                f.write(SCRIPT_TEMPLATE)
+            with open(os.path.join(scenario_dir, 'test', 'meta.json'), 'w') as f:
+                f.write('{"title": "Test"}')
+            url = reverse('scenarios:view', args=(self.course.key, self.scenario.key))
+            task_mac = get_mac_table(self.user, self.scenario).get_task_mac('sum')
+            timeout = ScriptTimeout('Script did not finish within 5 seconds')
+            with self.settings(SCENARIO_DIR=scenario_dir), \
+                    mock.patch('insekta.scenarios.dsl.tasks.call_script', side_effect=timeout):
+                response = self.client.post(url, {'task': task_mac, 'sum': '3'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'scenarios/render_error.html')
+        self.assertContains(response, 'did not finish within 5 seconds')
+        self.assertFalse(TaskSolve.objects.exists())
@@ -1,14 +1,17 @@
+import itertools
 import json
-from collections import defaultdict
+import logging
 
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
 from django.db.models import Prefetch
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 from django.urls import reverse
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render, redirect
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
 from django.middleware.csrf import get_token
 from django.conf import settings
@@ -20,14 +23,20 @@ from pygments.lexers import get_lexer_by_name
 
 from insekta.base.utils import describe_allowed_markup, sanitize_markup
 from insekta.remoteapi.client import remote_api, RemoteApiError
-from insekta.scenarios.dsl.renderer import Renderer
+from insekta.scenarios.dsl.renderer import Renderer, generate_scenario, render_scenario
 from insekta.scenarios.dsl.taskparser import ParserError
 from insekta.scenarios.dsl.tasks import TemplateTaskError
+from insekta.scenarios.grading import get_points_table
 from insekta.scenarios.models import (Scenario, ScenarioGroup, Notes,
-                                      CommentId, Comment, Course, CourseRun, TaskSolve, ScenarioError, TaskSolveArchive,
-                                      TaskGroup, Task, TaskConfiguration)
+                                      CommentId, Comment, Course, CourseRun, ScenarioError,
+                                      TaskGroup, Task)
 
 
+logger = logging.getLogger(__name__)
+
+# Replaced by the streamed scenario in the rendered scenario page
+STREAMING_MARKER = '<!-- insekta:rendered-scenario -->'
+
 COMPONENT_STYLESHEETS = {
 }
 COMPONENT_SCRIPTS = {
@@ -98,28 +107,47 @@ def _view_scenario(request, course_key, scenario_key):
     for script in scenario.get_javascript_files():
         additional_scripts.append(scenario_path + script)
 
-    # Load vm resources
+    # Load vm resources. If the remote API is not reachable, the scenario
+    # is rendered anyway and the vm panel tells that vms are unavailable.
     virtual_machines = {}
     expire_time = None
     vpn_ip = None
     vms_running = False
+    vms_unavailable = False
     vm_resource = scenario.get_vm_resource()
     if vm_resource:
-        resource_status = remote_api.get_vm_resource_status(vm_resource, request.user)
-        if resource_status['status'] == 'running':
-            vms_running = True
-            resource = resource_status['resource']
-            virtual_machines = resource['virtual_machines']
-            expire_time = resource['expire_time']
-        vpn_ip = resource_status['vpn_ip']
+        try:
+            resource_status = remote_api.get_vm_resource_status(vm_resource, request.user)
+        except RemoteApiError:
+            vms_unavailable = True
+        else:
+            if resource_status['status'] == 'running':
+                vms_running = True
+                resource = resource_status['resource']
+                virtual_machines = resource['virtual_machines']
+                expire_time = resource['expire_time']
+            vpn_ip = resource_status['vpn_ip']
 
     # Initialize renderer and submit request to it
     csrf_token = get_token(request)
-    renderer = Renderer(course, scenario, request.user, csrf_token, virtual_machines, vpn_ip)
+    streaming = settings.SCENARIO_STREAMING and request.method != 'POST'
     if request.method == 'POST':
+        renderer = Renderer(course, scenario, request.user, csrf_token, virtual_machines, vpn_ip)
         submit_result = renderer.submit(request.POST)
         if submit_result.is_correct:
             scenario.solve(request.user, submit_result.task, submit_result.answer)
+        rendered_scenario = renderer.render()
+    elif streaming:
+        scenario_parts = generate_scenario(course, scenario, request.user, csrf_token,
+                                           virtual_machines, vpn_ip)
+        # Errors in the first part are handled by view like in other pages
+        first_part = next(scenario_parts, '')
+        scenario_parts = _stream_scenario(itertools.chain([first_part], scenario_parts),
+                                          request.user)
+        rendered_scenario = mark_safe(STREAMING_MARKER)
+    else:
+        rendered_scenario = render_scenario(course, scenario, request.user, csrf_token,
+                                            virtual_machines, vpn_ip)
 
     try:
         notes = Notes.objects.get(user=request.user, scenario=scenario).content
@@ -129,14 +157,15 @@ def _view_scenario(request, course_key, scenario_key):
     comments_enabled = json.dumps(request.session.get('comments_enabled', True))
     num_user_comments = json.dumps(scenario.get_comment_counts())
 
-    return render(request, 'scenarios/view.html', {
+    context = {
         'course': course,
         'scenario': scenario,
-        'rendered_scenario': renderer.render(),
+        'rendered_scenario': rendered_scenario,
         'additional_stylesheets': additional_stylesheets,
         'additional_scripts': additional_scripts,
         'has_vms': vm_resource is not None,
         'vms_running': vms_running,
+        'vms_unavailable': vms_unavailable,
         'vms': virtual_machines,
         'vms_expire_time': expire_time,
         'vpn_running': vpn_ip is not None,
@@ -146,7 +175,26 @@ def _view_scenario(request, course_key, scenario_key):
         'num_user_comments': num_user_comments,
         'has_solved_all': scenario.has_solved_all(request.user),
         'is_supporting': scenario.is_supported_by(request.user),
-    })
+    }
+    if streaming:
+        # Send the page up to the scenario at once and stream the scenario
+        page = render_to_string('scenarios/view.html', context, request)
+        page_head, page_tail = page.split(STREAMING_MARKER, 1)
+        return StreamingHttpResponse(itertools.chain([page_head], scenario_parts, [page_tail]))
+    return render(request, 'scenarios/view.html', context)
+
+
+def _stream_scenario(scenario_parts, user):
+    try:
+        yield from scenario_parts
+    except Exception as e:
+        # The response was already started, so the error is shown in the page
+        logger.exception('Error while streaming scenario')
+        if user.is_superuser:
+            message = '{}: {}'.format(e.__class__.__name__, e)
+        else:
+            message = _('An error occurred while showing this scenario.')
+        yield '<p class="alert alert-danger">{}</p>\n'.format(escape(message))
 
 
 def download(request, course_key, scenario_key, download_key, filename):
@@ -254,10 +302,8 @@ def view_course(request, course_key, is_challenge=False):
     course = get_object_or_404(Course, key=course_key, enabled=True)
     if _has_to_register(course, request.user):
         return redirect('scenarios:course_registration', course.key)
-    scenario_groups = list(course.scenario_groups.filter(hidden=False).order_by('order_id'))
-    scenario_groups = ScenarioGroup.annotate_list(scenario_groups,
-                                                  is_challenge=is_challenge,
-                                                  user=request.user)
+    course_groups = ScenarioGroup.load_course_groups(course, user=request.user)
+    scenario_groups = course_groups.challenges if is_challenge else course_groups.topics
     return render(request, 'scenarios/view_course.html', {
         'course': course,
         'scenario_groups': scenario_groups,
@@ -285,7 +331,7 @@ def reset_tasks(request, course_key, scenario_key):
     if _has_to_register(course, request.user):
         return redirect('scenarios:course_registration', course.key)
     scenario = _get_scenario(scenario_key, request.user)
-    TaskSolve.objects.filter(user=request.user, task__scenario=scenario).delete()
+    scenario.reset_tasks(request.user)
     messages.success(request, _('The exercises were reset. You can now solve them again.'))
     return redirect('scenarios:show_options', course_key, scenario.key)
 
@@ -333,50 +379,7 @@ def _courserun_points_table(request, course_run_pk, participant=None):
     if participant:
         participants = participants.filter(pk=participant.pk)
     participants = list(participants)
-    archived_tasks = TaskSolveArchive.objects.filter(course_run=course_run)
-    solve_lookup = defaultdict(set)
-    for archived_task in archived_tasks:
-        solve_lookup[archived_task.user_id].add(archived_task.task_id)
-
-    task_points = {}
-    for task_config in TaskConfiguration.objects.filter(task_group__in=task_groups):
-        task_points[task_config.task_id] = task_config.points
-
-    participant_results = {}
-    max_tasks_points = 0
-    max_total_points = 0
-    for task_group in task_groups:
-        max_total_points += task_group.total_points
-        for task in task_group.tasks.order_by('order_id'):
-            max_tasks_points += task_points[task.pk]
-        for participant in participants:
-            results = participant_results.setdefault(participant.pk, {
-                'task_groups': [],
-                'total_points': 0,
-            })
-            group = {
-                'points': 0,
-                'solved_tasks': []
-            }
-            max_group_points = 0
-            for task in task_group.tasks.order_by('order_id'):
-                points = task_points[task.pk]
-                max_group_points += points
-                is_solved = task.pk in solve_lookup[participant.pk]
-                group['solved_tasks'].append(is_solved)
-                if is_solved:
-                    group['points'] += points
-            results['total_points'] += group['points']
-            group['points'] = group['points'] / max_group_points * task_group.total_points
-            results['task_groups'].append(group)
-    for participant in participants:
-        results = participant_results[participant.pk]
-        results['total_points'] /= max_tasks_points
-        results['total_points'] *= max_total_points
-        results['name'] = participant.get_full_name()
-        if not results['name']:
-            results['name'] = participant.username
-    points_table = list(participant_results.values())
+    points_table = get_points_table(course_run, task_groups, participants)
     ordering = request.GET.get('ordering', 'name')
     if ordering == 'points':
         ordering_fn = lambda entry: -entry['total_points']
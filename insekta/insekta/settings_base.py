@@ -109,6 +109,23 @@ LOCALE_PATHS = (os.path.join(BASE_DIR, 'locale'), )
 
 USE_REMOTE_API_DUMMY = True
 
+# Timeout in seconds for requests to the remote API
+REMOTE_API_TIMEOUT = 5
+
+# Number of retries of failed requests to the remote API
+REMOTE_API_RETRIES = 2
+
+# Maximum number of pooled connections to the remote API per worker process
+REMOTE_API_POOL_SIZE = 10
+
+# Seconds the status of vm resources is cached (in the default cache)
+REMOTE_API_STATUS_CACHE_TIMEOUT = 5
+
+# After this many consecutive failed requests, requests to the remote API
+# fail immediately for REMOTE_API_BREAKER_RESET_TIMEOUT seconds
+REMOTE_API_BREAKER_THRESHOLD = 5
+REMOTE_API_BREAKER_RESET_TIMEOUT = 30
+
 MESSAGE_TAGS = {
     message_constants.DEBUG: 'alert-info',
     message_constants.INFO: 'alert-info',
@@ -118,3 +135,86 @@ MESSAGE_TAGS = {
 }
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# The default cache must be shared by all worker processes: cached badge
+# counts, task ids, vm statuses and script values are invalidated by
+# deleting them from it. The cache table is created by migrate. Redis or
+# Memcached are faster, see settings.py.example.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'insekta_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+
+
+# Scenario rendering
+
+# Number of compiled scenario templates kept in memory per worker process
+SCENARIO_TEMPLATE_CACHE_SIZE = 64
+
+# Number of parsed tasks, choices and answers kept in memory per worker process
+SCENARIO_TASK_CACHE_SIZE = 20000
+
+# Number of (user, scenario) pairs whose task and choice MACs are kept in memory
+SCENARIO_MAC_CACHE_SIZE = 4096
+
+# Number of characters of rendered scenarios kept in memory per worker
+# process and the number of seconds they are kept. 0 disables the cache.
+SCENARIO_OUTPUT_CACHE_SIZE = 64 * 1024 * 1024
+SCENARIO_OUTPUT_CACHE_TIMEOUT = 300
+
+# Stream scenario pages: the page header is sent at once and the scenario
+# is sent while it is rendered
+SCENARIO_STREAMING = False
+
+# Number of characters of highlighted code kept in memory per worker process
+SCENARIO_HIGHLIGHT_CACHE_SIZE = 32 * 1024 * 1024
+
+# Directory where highlighted code is cached on disk, disabled if None
+SCENARIO_HIGHLIGHT_CACHE_DIR = None
+
+# Scenario files are checked for modifications at most once per interval (seconds)
+SCENARIO_FILE_CHECK_INTERVAL = 2
+
+# Watch scenario files with inotify instead of checking them periodically.
+# Requires the inotify_simple package.
+SCENARIO_FILE_WATCH = False
+
+# Number of loaded scripts.py modules of scenarios kept in memory per process
+SCENARIO_SCRIPT_CACHE_SIZE = 256
+
+# Number of worker processes running the scripts.py of scenarios, e.g. the
+# number of CPU cores. With 0, scripts run inside the web worker without
+# time and memory limits.
+SCENARIO_SCRIPT_WORKERS = 0
+
+# Maximum time in seconds a single call of a scenario script may take
+SCENARIO_SCRIPT_TIMEOUT = 5
+
+# Maximum address space of a script worker process in bytes
+SCENARIO_SCRIPT_MEMORY_LIMIT = 1024 * 1024 * 1024
+
+# Seconds the values generated by scenario scripts are kept in the cache.
+# Changing scripts.py invalidates them immediately.
+SCENARIO_SCRIPT_VALUES_CACHE_TIMEOUT = 7 * 24 * 3600
+
+
+# Scenario help
+
+# Seconds the numbers in the navigation badges are cached per user. They are
+# invalidated when questions or supported scenarios change.
+SCENARIOHELP_BADGE_CACHE_TIMEOUT = 600
+
+# Number of questions per page in the question lists
+SCENARIOHELP_QUESTIONS_PER_PAGE = 25
+
+# Seconds the number of solved questions of a scenario is cached. It is
+# invalidated when a question is marked as solved.
+SCENARIOHELP_COUNT_CACHE_TIMEOUT = 3600
+
+# Maximum number of questions shown as search results
+SCENARIOHELP_SEARCH_LIMIT = 50